@@ -3,18 +3,23 @@
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '7'
 import torch
-from sklearn.metrics import f1_score, accuracy_score, hamming_loss, classification_report, jaccard_score, classification_report
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from sklearn.metrics import f1_score, classification_report, jaccard_score, classification_report
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from transformers import AutoTokenizer, AutoModelForSequenceClassification,\
 AdamW, get_linear_schedule_with_warmup
-from BertCNNClassifier_att import BertCNNClassifier_att
+from BertCNNClassifier_att import BertCNNClassifier_att, quantize_int8
 import numpy as np
-import pandas as pd
 import random
+import time
 from tqdm import trange
 import yaml
+import json
 import argparse
 from util_loss import ResampleLoss
+from util_checkpoint import checkpoint_path, quantized_path, save_checkpoint, load_into
+from onnx_backend import onnx_path, export_onnx, OnnxClassifier
+from compiled_backend import SEQUENCE_BUCKETS, CompiledClassifier
+from util_data import LABEL_VOCAB, read_reviews, encode_multi_hot, pack_labels, pack_label_tensor, unpack_label_tensor, bit_metrics, dedup_reviews, TokenizedDataset, StreamingReviewDataset, TokenBudgetBatchSampler, PackedBatchSampler, PadCollator, PackCollator, DevicePrefetcher, restore_order, tokenize_parallel, token_cache_path, load_token_cache, save_token_cache, load_manifest
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -52,73 +57,177 @@ def load_model(save_path):
     
     if args['modelname'] == 'CBloss_bigbird_GLEE_atten_kernel_2_3':
         model = BertCNNClassifier_att(num_labels=args['num_labels'], mlp_size=args['mlp_size'], 
-                                      bert_output_dim=768, conv_out_channels=256, kernel_sizes=[1, 2])
+                                      bert_output_dim=768, conv_out_channels=256, kernel_sizes=[1, 2],
+                                      window_size=args.get('window_size'), window_stride=args.get('window_stride'),
+                                      packing=args.get('packing', False), standard_layer_norm=args.get('standard_layer_norm', False),
+                                      pretrained=False) # Backbone built from its config only; every weight comes from the checkpoint below.
         model.to(device)
         
         tokenizer_path = '/data/0WYJ/newdata_wyj/CMLTES_codes/multi_class/Bigbird_PRE' 
         tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
 
-    checkpoint = torch.load(save_path) # Load the parameters of the model.
-    model_state_dict = checkpoint['state_dict'] # Get the parameters of the model.
-    model.load_state_dict(model_state_dict) # Load the parameters of the model.
+    if args.get('inference_backend') == 'onnx':
+        # The graph written by -mode export_onnx, run with ONNX Runtime on the CPU; the torch model above is not loaded.
+        return OnnxClassifier(onnx_path(save_path), num_threads=args.get('onnx_threads')), tokenizer
+    if args.get('quantized'):
+        # The int8 model written by -mode quantize: the same modules with dynamically quantized Linears, CPU only.
+        quantize_int8(model)
+        model.checkpoint_metadata = load_into(model, quantized_path(save_path), device)
+    else:
+        # The torch.save .pt checkpoint, or its memory-mapped .safetensors sibling with checkpoint_format: safetensors.
+        model.checkpoint_metadata = load_into(model, checkpoint_path(save_path, args.get('checkpoint_format', 'torch')), device) # Load the parameters of the model.
     
     return model, tokenizer
 
 def get_dataloader(path, tokenizer, train:bool): 
-    text, labels = get_data(path, tokenizer) # Call the get_data method to load the dataset and store the text data and labels data in the text and labels variables respectively.
-    dataloader = new_dataloader(text, labels, train) # Call the dataloader method to get the data loader and store it in the dataloader variable.
+    if train and args.get('streaming'):
+        return get_streaming_dataloader(path, tokenizer)
+    data = get_data(path, tokenizer) # Call the get_data method to load and tokenize the dataset.
+    dataloader = new_dataloader(data, train, tokenizer.pad_token_id) # Call the dataloader method to get the data loader and store it in the dataloader variable.
     return dataloader
 
+def get_streaming_dataloader(path, tokenizer):
+    # The CSV is read chunk by chunk and tokenized lazily, so the training set never has to fit in memory.
+    if args.get('dedup'):
+        raise ValueError('dedup groups duplicates across the whole split and cannot be combined with streaming')
+    data = StreamingReviewDataset(path, tokenizer, args['max_length'], get_label_bits, num_rows=args['num_samples'],
+                                  chunk_size=args.get('stream_chunk_size', 10000), shuffle_buffer=args.get('shuffle_buffer', 50000))
+    return streaming_dataloader(data, tokenizer.pad_token_id)
+
+def streaming_dataloader(data, pad_token_id, max_length=None):
+    max_length = max_length or args['max_length']
+    pad_to = None if args.get('dynamic_padding') else max_length
+    return DataLoader(data, batch_size=args['batch_size'], collate_fn=PadCollator(pad_token_id, pad_to=pad_to), **loader_kwargs())
+
+def epoch_max_length(epoch):
+    # max_length_schedule maps a starting epoch to a training max_length, e.g. {0: 128, 10: 512}; the last start <= epoch wins.
+    schedule = args.get('max_length_schedule')
+    if not schedule:
+        return args['max_length']
+    starts = [start for start in sorted(schedule) if int(start) <= epoch]
+    return min(int(schedule[starts[-1]]), args['max_length']) if starts else args['max_length']
+
+def epoch_dataloader(dataloader, max_length, pad_token_id):
+    # A training loader whose batches are built around the rows re-sliced to max_length (no re-tokenization).
+    # The dataset is left at its current length; the training loop switches it with set_max_length when it switches loaders.
+    data = dataloader.dataset
+    current = data.max_length
+    data.set_max_length(max_length)
+    try:
+        if isinstance(data, StreamingReviewDataset):
+            return streaming_dataloader(data, pad_token_id, max_length)
+        return new_dataloader(data, True, pad_token_id, max_length=max_length)
+    finally:
+        data.set_max_length(current)
+
+def planned_steps(dataloader, epochs):
+    # Batches of the next epochs of a loader; shuffled token-budget batches are drawn ahead, so the count is exact.
+    if hasattr(dataloader.batch_sampler, 'plan'):
+        return sum(dataloader.batch_sampler.plan(epochs))
+    if isinstance(dataloader.dataset, StreamingReviewDataset):
+        # Each worker ends its share of the chunks with its own partial batch, which len(dataloader) does not count.
+        return dataloader.dataset.num_batches(dataloader.batch_size, dataloader.num_workers) * epochs
+    return len(dataloader) * epochs
+
 def get_data(path, tokenizer):
-    
-    text, labels = load_dataset(path) # Call the load_dataset method to load the dataset and store the text data and labels data in the text and labels variables respectively.
-    #text = tokenizer(text, padding=True, truncation=True,  max_length=max_length, return_tensors='pt') 
-    text = tokenizer(text, padding='max_length', truncation=True, return_tensors='pt', max_length=args['max_length']) 
-    text = text.to(device)  # move text to GPU *
-    return text, labels
-
-def new_dataloader(text, labels, train:bool): # This code defines a method called dataloader to get the data loader.
-    data = TensorDataset(text['input_ids'], text['attention_mask'], torch.tensor(labels)) 
+    # The tokenized dataset stays on the CPU; batches are padded by PadCollator and copied to the device one at a time.
+    cache_path = None
+    if args.get('token_cache_dir'):
+        digest = load_manifest(path, args.get('label_vocab', LABEL_VOCAB))['sha1'] # Content hash from the manifest sidecar.
+        cache_path = token_cache_path(args['token_cache_dir'], digest, tokenizer, args['max_length'],
+                                      label_vocab=args.get('label_vocab', LABEL_VOCAB), dedup=args.get('dedup'))
+        data = load_token_cache(cache_path) # Memory-mapped token ids and labels from an earlier run, if any.
+        if data is not None:
+            return data
+
+    text, labels = load_dataset(path)
+    counts = inverse = None
+    if args.get('dedup'):
+        # Duplicate reviews (same normalized text and labels) are tokenized and run once;
+        # counts weight the training loss and inverse fans predictions back out to every CSV row.
+        keep, counts, inverse = dedup_reviews(text, labels)
+        text, labels = [text[i] for i in keep], labels[keep]
+    # Shards are tokenized in a process pool and kept in order; padding is done per batch in PadCollator.
+    ids, offsets = tokenize_parallel(text, tokenizer, args['max_length'], num_proc=args.get('tokenize_workers', 1))
+    data = TokenizedDataset(ids, offsets, labels, counts=counts, inverse=inverse) # Labels are one uint8 bitmask per review.
+    if cache_path is not None:
+        save_token_cache(cache_path, data, source=path)
+    return data
+
+def loader_kwargs():
+    # Worker processes build padded batches in the background; pinned batches can be copied to the GPU asynchronously.
+    kwargs = {'num_workers': args.get('num_workers', 0), 'pin_memory': device.type == 'cuda'}
+    if kwargs['num_workers'] > 0:
+        kwargs['prefetch_factor'] = args.get('prefetch_factor', 2)
+        kwargs['persistent_workers'] = True
+    return kwargs
+
+def new_dataloader(data, train:bool, pad_token_id=0, max_length=None): # This code defines a method called dataloader to get the data loader.
+    max_length = max_length or args['max_length'] # Shorter than args['max_length'] for the early epochs of a max_length_schedule.
+    if args.get('packing'):
+        # Short reviews share sequences of pack_length tokens; the model keeps them apart with block-diagonal attention.
+        pack_length = args.get('pack_length') or max_length
+        batch_sampler = PackedBatchSampler(data.lengths, pack_length, packs_per_batch=args.get('packs_per_batch') or args['batch_size'], shuffle=train)
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=PackCollator(pad_token_id, pack_length), **loader_kwargs())
+    if args.get('dynamic_padding'):
+        # Batches of similar-length reviews, each padded only to its own longest member.
+        batch_sampler = TokenBudgetBatchSampler(data.lengths, max_tokens=args.get('max_tokens') or args['batch_size'] * max_length,
+                                                shuffle=train, max_batch_size=args.get('max_batch_size'))
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=PadCollator(pad_token_id), **loader_kwargs())
+    collate_fn = PadCollator(pad_token_id, pad_to=max_length)
     
     if train:
         sampler = RandomSampler(data) # Create a random sampler.
         dataloader = DataLoader(data, # Create a data loader.
                                 sampler=sampler, # A random sampler was used.
-                                batch_size=args['batch_size']) # Set the batch size.
+                                batch_size=args['batch_size'], # Set the batch size.
+                                collate_fn=collate_fn,
+                                **loader_kwargs())
     else:
         sampler = SequentialSampler(data) # Creates a sequential sampler.
         dataloader = DataLoader(data, # Create a data loader.
                                 sampler=sampler, # Sequential samplers are used.
-                                batch_size=args['batch_size']) # Set the batch size.
+                                batch_size=args['batch_size'], # Set the batch size.
+                                collate_fn=collate_fn,
+                                **loader_kwargs())
         
     return dataloader
 
 def load_dataset(path): # This code defines a method called load_dataset for loading datasets.
-    df = pd.read_csv(path, index_col=False) # Use the pandas library to read the dataset. and store it in the DataFrame object df.
-    text = df['description'].tolist()  # Convert the ‘temp’ column in the DataFrame object df to a list and store it in the text variable.
-    # Here temp stores the text of the original tweet minus the special symbols.
-    label = df[['label1', 'label2', 'label3','label4','label5','label6','label7','label8']].values.tolist()
+    # CSV, Parquet or Arrow IPC/Feather; only the description and label1..label8 columns are read.
+    text, label = read_reviews(path)
     # print(label[0]) # Print the first of the labels
-    label = get_one_hot_encode(label)
+    label = get_label_bits(label)
     return text, label
 
 def get_one_hot_encode(labels):
-    unique_label = np.array(['旅游交通', '游览', '旅游安全', '卫生', '邮电', '旅游购物', '经营管理', '资源和环境保护']) 
-    
-    one_hot = np.zeros((len(labels), args['num_labels'])) # Create an all-zero matrix with the number of rows as the number of labels and the number of columns as the number of labels.
-    
-    for i in range(len(labels)): # Iterate through the list of tags.
-        for j in range(8): # Iterates through each tag in the tag list.
-            try: # Try converting the tag to one-hot encoding.
-                idx = np.where(unique_label == labels[i][j])[0][0] # Gets the index of the tag in the list of tags.
-                one_hot[i][idx] = 1 # Set the corresponding position in the one-hot code to 1.
-            except:   # If the label is not in the label list, it is skipped.
-                continue 
-            
-    return one_hot
+    # Vectorized: all label cells are mapped to vocabulary indices in one categorical pass, missing labels are skipped.
+    return encode_multi_hot(labels, args.get('label_vocab', LABEL_VOCAB))
+
+def get_label_bits(labels):
+    # One uint8 bitmask per review (bit j = label_vocab[j]); floats are only unpacked on the device for the loss.
+    return pack_labels(get_one_hot_encode(labels))
+
+def dataset_counts(dataloader):
+    # Multiplicity of every row of a deduplicated split as a device tensor indexed by row index, None otherwise.
+    counts = getattr(dataloader.dataset, 'counts', None)
+    return None if counts is None else torch.as_tensor(np.asarray(counts)).to(device)
+
+def batch_rows(dataloader):
+    # Rows per batch averaged over the split: the fixed normalizer of the duplicate-weighted loss, so a group of
+    # copies weighs in an epoch as much as the copies would without dedup, whatever else is in its batch.
+    return len(dataloader.dataset) / max(len(dataloader), 1)
 
 def save_model(epoch, model, model_save_dir):
     
+    if args.get('checkpoint_format') == 'safetensors':
+        # Memory-mappable checkpoint, optionally half precision on disk, with what is needed to rebuild and use it in its header.
+        metadata = {'epoch': epoch, 'modelname': args['modelname'], 'num_labels': args['num_labels'], 'mlp_size': args['mlp_size'],
+                    'kernel_sizes': [model.conv1.kernel_size[0], model.conv2.kernel_size[0]], 'threshold': 0.5,
+                    'label_vocab': list(args.get('label_vocab', LABEL_VOCAB))}
+        save_checkpoint(checkpoint_path(model_save_dir, 'safetensors'), model.state_dict(), metadata, dtype=args.get('checkpoint_dtype'))
+        return
+
     checkpoint = {'epoch': epoch, \
                     'state_dict': model.state_dict()
                     }
@@ -143,11 +252,23 @@ def main(args):
 
     tokenizer = initialise_tokenizer(args['modelname'])
 
-    model = BertCNNClassifier_att(num_labels=args['num_labels'], mlp_size=args['mlp_size'])
+    model = BertCNNClassifier_att(num_labels=args['num_labels'], mlp_size=args['mlp_size'],
+                                  window_size=args.get('window_size'), window_stride=args.get('window_stride'),
+                                  packing=args.get('packing', False), standard_layer_norm=args.get('standard_layer_norm', False))
 
     model = model.to(device)
 
-    num_training_steps = args['num_epochs'] * (args['num_samples'] // args['batch_size']) #Total training steps
+    train_dataloader = get_dataloader(args['traincsvpath'], tokenizer, train=True) # Training data loader.
+    valid_dataloader = get_dataloader(args['valcsvpath'], tokenizer, train=False) # Validate the data loader.
+
+    # Training max_length per epoch; validation always runs at the full max_length.
+    epoch_lengths = [epoch_max_length(epoch) for epoch in range(args['num_epochs'])]
+    # One training loader per distinct length, built once and reused by all its epochs, so the total counts the batches actually taken.
+    train_dataloaders = {length: epoch_dataloader(train_dataloader, length, tokenizer.pad_token_id) for length in sorted(set(epoch_lengths))}
+    num_training_steps = sum(planned_steps(loader, epoch_lengths.count(length)) for length, loader in train_dataloaders.items()) #Total training steps
+    train_length = None
+    epoch_seconds = [] # Wall-clock seconds of every epoch, training plus validation.
+    wait_seconds = [] # Seconds of every epoch's training loop spent blocked on the data pipeline.
 
     optimizer, scheduler = initialise_optimizer(model, num_training_steps)
 
@@ -158,13 +279,17 @@ def main(args):
                              class_freq=args['class_freq'], train_num=args['num_samples'])
     
 
-    train_dataloader = get_dataloader(args['traincsvpath'], tokenizer, train=True) # Training data loader.
-    valid_dataloader = get_dataloader(args['valcsvpath'], tokenizer, train=False) # Validate the data loader.
-
     for actual_epoch in trange(args['num_epochs'], desc="Epoch"):
         
-        epoch_train_loss = train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch)   
+        epoch_start = time.perf_counter()
+        if epoch_lengths[actual_epoch] != train_length:
+            train_length = epoch_lengths[actual_epoch]
+            train_dataloader = train_dataloaders[train_length]
+            train_dataloader.dataset.set_max_length(train_length) # Rows are sliced to the length this loader's batches were built for.
+        
+        epoch_train_loss, wait_time = train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch)   
         train_loss_set.append(epoch_train_loss) # Add the training loss of the current epoch to train_loss_set.
+        wait_seconds.append(wait_time)
         
         epoch_eval_loss, micro, macro, accuracy, weighted_f1, jaccard, hl = validate(model, valid_dataloader, loss_func, actual_epoch) # Evaluate the model on the validation set.
         valid_loss_set.append(epoch_eval_loss) # Add the assessed loss value to the list.
@@ -183,6 +308,15 @@ def main(args):
             if macro > best_macro:
                 best_macro = macro
                 save_model(actual_epoch, model, args['model_save_dir'] + '/best_macro_model_att_large.pt')
+        epoch_seconds.append(time.perf_counter() - epoch_start)
+
+    # Per-epoch training length, time, data-wait time and validation macro-F1; compare a scheduled run against a fixed-length one with benchmark.py schedule.
+    best_epoch = int(np.argmax(macro_scores))
+    print("Trained {} epochs in {:.1f}s, best macro-F1 {:.4f} after {:.1f}s".format(
+        len(epoch_seconds), sum(epoch_seconds), macro_scores[best_epoch], sum(epoch_seconds[:best_epoch + 1])))
+    with open(args['model_save_dir'] + '/training_log.json', 'w') as f:
+        json.dump({'max_length': epoch_lengths, 'epoch_seconds': epoch_seconds, 'wait_time': wait_seconds,
+                   'macro': [float(m) for m in macro_scores]}, f, indent=1)
 
 
 def train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch):
@@ -191,20 +325,23 @@ def train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch
     
     tr_loss = 0 # Used to store the training loss for the current epoch.
     num_train_samples = 0 # The number of training samples used to store the current epoch.
+    sample_weights = dataset_counts(train_dataloader) # Duplicates per row of a deduplicated training set, else None.
+    sample_norm = None if sample_weights is None else batch_rows(train_dataloader)
     
-    for _, batch in enumerate(train_dataloader):  # Use the enumerate function to traverse the batch data in the training data loader (train_dataloader).
-        
-        batch = tuple(t.to(device) for t in batch) # Move batch data to the GPU.
+    batches = DevicePrefetcher(train_dataloader, device, depth=args.get('prefetch_depth', 2)) # Batches are copied to the GPU by a background thread ahead of use.
+
+    for _, batch in enumerate(batches):  # Use the enumerate function to traverse the batch data in the training data loader (train_dataloader).
         
-        b_input_ids, b_input_mask, b_labels = batch # Unpacks batch data into input IDs, input masks, and labels.
+        b_input_ids, b_input_mask, b_labels, b_index = batch # Unpacks batch data into input IDs, input masks, labels and row indices.
+        b_weight = None if sample_weights is None else sample_weights[b_index]
     
         optimizer.zero_grad()
         logits = model(b_input_ids, attention_mask=b_input_mask)
-        loss = loss_func(logits.view(-1,args['num_labels']), b_labels.type_as(logits).view(-1,args['num_labels']))
+        loss = loss_func(logits.view(-1,args['num_labels']), unpack_label_tensor(b_labels, args['num_labels']).type_as(logits), sample_weight=b_weight, sample_norm=sample_norm)
         
         tr_loss += loss.item()
         
-        num_train_samples += b_labels.size(0) # Adds the number of samples in the batch to num_train_samples. Accumulate the number of samples
+        num_train_samples += b_labels.size(0) if b_weight is None else b_weight.sum().item() # Adds the number of samples in the batch to num_train_samples. Accumulate the number of samples
         
         loss.backward() # Calculate the gradient of the loss.        
         optimizer.step() # Update the model parameters.
@@ -214,7 +351,7 @@ def train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch
 
     # print("\nTrain loss after Epoch {} : {}".format(actual_epoch, epoch_train_loss)) # Prints the training loss for the current epoch.
     
-    return epoch_train_loss
+    return epoch_train_loss, batches.wait_time # The time the training loop was blocked on the data pipeline goes to training_log.json.
 
 
 @torch.no_grad()
@@ -227,42 +364,39 @@ def validate(model, valid_dataloader, loss_func, epoch, threshold=0.5):
     
     pred_labels = [] # Create an empty list for storing prediction labels.
     true_labels = [] # Creates an empty list to store the original labels.
+    batch_indices = [] # Row indices of every batch, used to restore the CSV order.
+    sample_weights = dataset_counts(valid_dataloader) # Duplicates per row of a deduplicated split, else None.
+    sample_norm = None if sample_weights is None else batch_rows(valid_dataloader)
     
-    for _, batch in enumerate(valid_dataloader): # Use the enumerate function to iterate through the batch data in the validation data loader.
+    for _, batch in enumerate(DevicePrefetcher(valid_dataloader, device, depth=args.get('prefetch_depth', 2))): # Use the enumerate function to iterate through the batch data in the validation data loader.
         
-        batch = tuple(t.to(device) for t in batch) # Move batch data to the GPU.
-        b_input_ids, b_input_mask, b_labels = batch # Get batch data.
+        b_input_ids, b_input_mask, b_labels, b_index = batch # Get batch data.
+        b_weight = None if sample_weights is None else sample_weights[b_index]
         
         logits = model(b_input_ids, attention_mask=b_input_mask)  # Get logits directly                        
         loss = loss_func(logits.view(-1,args['num_labels']), 
-                                b_labels.type_as(logits).view(-1,args['num_labels'])) # Calculate the value of the loss.
+                                unpack_label_tensor(b_labels, args['num_labels']).type_as(logits), sample_weight=b_weight, sample_norm=sample_norm) # Calculate the value of the loss.
             
-        pred_label = torch.sigmoid(logits) # Use the sigmoid function to convert predictions to probability values.
+        pred_label = pack_label_tensor(torch.sigmoid(logits) > threshold) # Thresholded probabilities as one bitmask per review.
         pred_label = pred_label.to('cpu').numpy() # Move the prediction label to the CPU.
         b_labels = b_labels.to('cpu').numpy() # Move the original label to the CPU.
             
         pred_labels.append(pred_label) # Add the prediction tag to the list.
         true_labels.append(b_labels) # Add the original tag to the list.
+        batch_indices.append(b_index.to('cpu').numpy())
 
         eval_loss += loss.item() 
-        num_eval_samples += b_labels.shape[0]
+        num_eval_samples += b_labels.shape[0] if b_weight is None else b_weight.sum().item()
 
     epoch_eval_loss = eval_loss/num_eval_samples # Calculate the value of the assessed loss.
 
     # print("Val loss after Epoch {} : {}".format(epoch, epoch_eval_loss)) # Prints the training loss for the current epoch.        
 
-    pred_labels = [item for sublist in pred_labels for item in sublist] # Convert prediction labels to a one-dimensional list.
-    true_labels = [item for sublist in true_labels for item in sublist] # Converts raw labels to a one-dimensional list.
-    
-    pred_bools = [pl>threshold for pl in pred_labels]
-    true_bools = [tl==1 for tl in true_labels]
+    pred_labels = valid_dataloader.dataset.fan_out(restore_order(pred_labels, batch_indices)) # Put the predictions back in CSV order, one per duplicate.
+    true_labels = valid_dataloader.dataset.fan_out(restore_order(true_labels, batch_indices)) # Put the original labels back in CSV order.
     
-    micro = f1_score(true_bools, pred_bools, average='micro')
-    macro = f1_score(true_bools, pred_bools, average='macro')
-    accuracy = accuracy_score(true_bools, pred_bools)
-    weighted_f1 = f1_score(true_bools, pred_bools, average='weighted') 
-    jaccard = jaccard_score(true_bools, pred_bools, average='weighted') 
-    hl = hamming_loss(true_bools, pred_bools)
+    # Popcount metrics on the bitmasks, equal to sklearn's f1/accuracy/jaccard/hamming on the boolean matrices.
+    micro, macro, accuracy, weighted_f1, jaccard, hl = bit_metrics(true_labels, pred_labels, args['num_labels'])
 
     # print("Valid loss: {}".format(epoch_eval_loss))
     # print(f"Micro Validaton Score: ", micro)
@@ -278,24 +412,54 @@ def validate(model, valid_dataloader, loss_func, epoch, threshold=0.5):
 @torch.no_grad()
 def test(save_path): # Define the test function, which is used to evaluate the model on a test set.
         
-    pred_labels = [] # Define empty list for storing prediction labels.
-    true_labels = [] # Define empty list for storing real labels.
-    
+    if args.get('compiled_inference') and args.get('inference_backend') == 'onnx':
+        raise ValueError('compiled_inference compiles the PyTorch model and cannot be combined with inference_backend: onnx')
+
     model, tokenizer = load_model(save_path) # Loading Models.
     model = model.to(device)     # Moves the model to the specified device.
     model.eval()
 
+    if args.get('compiled_inference'):
+        # One graph per sequence-length bucket, all built here before the first batch; batches are padded to their bucket.
+        model = CompiledClassifier(model, buckets=args.get('compile_buckets') or SEQUENCE_BUCKETS,
+                                   backend=args.get('compile_backend', 'auto'), pad_token_id=tokenizer.pad_token_id)
+        print("Compiled {} graphs for sequence lengths {} in {:.1f}s".format(model.backend, model.buckets, model.compile_seconds))
+
     test_dataloader = get_dataloader(args['testcsvpath'], tokenizer, train=False) # Test Data Loader.
     
 
     # unique_label = np.array(['旅游交通', '游览', '旅游安全', '卫生', '邮电', '旅游购物', '经营管理', '资源和环境保护'])
 
-    for idx, batch in enumerate(test_dataloader): # The data loader that traverses the test set.
-        batch = tuple(t.to(device) for t in batch) # Moves data to the specified device.
-        b_input_ids, b_input_mask, b_labels = batch # Get input data.
+    threshold = model.checkpoint_metadata.get('threshold', 0.50) # Stored in the header of safetensors checkpoints.
+
+    true_labels, pred_labels = predict(model, test_dataloader, threshold)
+
+    if args.get('prediction_path'):
+        np.save(args['prediction_path'], pred_labels) # One uint8 bitmask per CSV row, bit j = label_vocab[j].
+
+    # print(f"Macro F1 Based: Macro F1: {macro}, Micro F1: {micro}, weighted_f1: {weighted_f1}, jaccard: {jaccard}, hamming loss:{hl} and Accuracy: {accuracy}") #Performance metrics for printing models.
+    
+    ## Calculation Acccuracy:
+    # Popcount metrics on the bitmasks, equal to sklearn's f1/accuracy/jaccard/hamming on the boolean matrices.
+    micro, macro, accuracy, weighted_f1, jaccard, hl = bit_metrics(true_labels, pred_labels, args['num_labels'])
+    
+    print(f"TEST FOR " + args['modelname'] + " and Batch Size" + str(args['batch_size']))
+
+    print(f"Macro F1 Based: Macro F1: {macro}, Micro F1: {micro}, weighted_f1: {weighted_f1}, jaccard: {jaccard},hamming loss:{hl} and Accuracy: {accuracy}") # Printed model performance metrics.
+
+
+@torch.no_grad()
+def predict(model, test_dataloader, threshold=0.50):
+    # Thresholded predictions and real labels of a split as uint8 bitmasks, in CSV order with one row per CSV row.
+    pred_labels = [] # Define empty list for storing prediction labels.
+    true_labels = [] # Define empty list for storing real labels.
+    batch_indices = [] # Row indices of every batch, used to restore the CSV order.
+
+    for idx, batch in enumerate(DevicePrefetcher(test_dataloader, device, depth=args.get('prefetch_depth', 2))): # The data loader that traverses the test set, batches already on the device.
+        b_input_ids, b_input_mask, b_labels, b_index = batch # Get input data.
         
         logits = model(b_input_ids, attention_mask=b_input_mask)  # Get logits directly
-        pred_label = torch.sigmoid(logits) # Perform a sigmoid operation on the output of the model.
+        pred_label = pack_label_tensor(torch.sigmoid(logits) > threshold) # Perform a sigmoid operation on the output of the model and keep the labels above the threshold as a bitmask.
         # print(pred_label)
             
         pred_label = pred_label.to('cpu').numpy() # Move the prediction label to the CPU.
@@ -303,6 +467,7 @@ def test(save_path): # Define the test function, which is used to evaluate the m
         
         pred_labels.append(pred_label) # Add prediction labels to pred_labels.
         true_labels.append(b_labels) # Add true labels to true_labels.
+        batch_indices.append(b_index.to('cpu').numpy())
 
         # Decode the predicted labels for each sample.
         # for i, label_scores in enumerate(pred_label):
@@ -310,49 +475,64 @@ def test(save_path): # Define the test function, which is used to evaluate the m
         #     predicted_labels = unique_label[label_indices]  # Gets the name of the predicted label.
         #     print(f"Sample {idx * test_dataloader.batch_size + i} predicting label is: {predicted_labels}")  # Print the prediction labels for the samples.
     
-    y_pred = pred_labels #Assigns the prediction label to y_pred.
-    y_true = true_labels #Assign the true label to y_true.
-    
-    pred_labels = [item for sublist in pred_labels for item in sublist] # Convert prediction labels to a one-dimensional list.
-    true_labels = [item for sublist in true_labels for item in sublist] # Convert real labels to one-dimensional lists.
-    
-    # single_true, multi_true, single_pred, multi_pred, true, predictions = metric_calculation(y_true, y_pred)
+    pred_labels = test_dataloader.dataset.fan_out(restore_order(pred_labels, batch_indices)) # Put the predictions back in CSV order, one per duplicate.
+    true_labels = test_dataloader.dataset.fan_out(restore_order(true_labels, batch_indices)) # Put the real labels back in CSV order.
+    return true_labels, pred_labels
 
-    predictions = [] # Define the predictions variable.
-    for i in y_pred: # Iterate over y_pred.
-        for j in i: # Iterate over i.
-            pred = [] # Define the pred variable.
-            for k in j: # Iterate over j.
-                if k > 0.5: # If k is greater than 0.5.
-                    pred.append(1) # Add 1 to pred.
-                else: 
-                    pred.append(0) # Add 0 to pred.
-            predictions.append(pred) # Adds pred to predictions.
 
-    true = [] # Define the true variable.
-    for i in y_true: # Iterate over y_true.
-        for j in i:  # Iterate over i.
-            true_ = [] # Define the true_ variable.
-            for k in j: # Iterate over j.
-                true_.append(int(k)) # Add int(k) to true_.
-            true.append(true_) # Add true_ to true.
-    # print(f"Macro F1 Based: Macro F1: {macro}, Micro F1: {micro}, weighted_f1: {weighted_f1}, jaccard: {jaccard}, hamming loss:{hl} and Accuracy: {accuracy}") #Performance metrics for printing models.
-    
-    ## Calculation Acccuracy:
-    threshold = 0.50
-    pred_bools = [pl>threshold for pl in pred_labels] # Converts prediction labels to boolean values.
-    true_bools = [tl==1 for tl in true_labels] # Converts real labels to boolean values.
-    
-    micro = f1_score(true_bools, pred_bools, average='micro') # Calculate the micro F1 score.
-    accuracy = accuracy_score(true_bools, pred_bools) # Calculate the accuracy.
-    macro = f1_score(true_bools, pred_bools, average='macro') # Calculate the macro F1 score.
-    weighted_f1 = f1_score(true_bools, pred_bools, average='weighted') 
-    jaccard = jaccard_score(true_bools, pred_bools, average='weighted') 
-    hl = hamming_loss(true_bools, pred_bools)
-    
-    print(f"TEST FOR " + args['modelname'] + " and Batch Size" + str(args['batch_size']))
+@torch.no_grad()
+def quantize(save_path): # Define the quantize function, which writes a dynamically quantized int8 model for CPU inference.
+
+    model, tokenizer = load_model(save_path) # The fp32 model, on the CPU.
+    model.eval()
+    test_dataloader = get_dataloader(args['testcsvpath'], tokenizer, train=False)
+    threshold = model.checkpoint_metadata.get('threshold', 0.50)
+
+    # The int8 model is only written if its test F1 stays within quantize_max_drop of the fp32 model.
+    scores = {}
+    for precision in ('fp32', 'int8'):
+        if precision == 'int8':
+            quantize_int8(model) # Backbone Linears, local_fc and the classifier MLP get int8 weights.
+        start = time.perf_counter()
+        true_labels, pred_labels = predict(model, test_dataloader, threshold)
+        micro, macro = bit_metrics(true_labels, pred_labels, args['num_labels'])[:2]
+        scores[precision] = {'macro': float(macro), 'micro': float(micro), 'seconds': time.perf_counter() - start}
+        print("{}: Macro F1: {:.4f}, Micro F1: {:.4f}, {:.1f}s on the test set".format(precision, macro, micro, scores[precision]['seconds']))
+
+    drop = max(scores['fp32']['macro'] - scores['int8']['macro'], scores['fp32']['micro'] - scores['int8']['micro'])
+    if drop > args.get('quantize_max_drop', 0.01):
+        print("Not saving the int8 model: F1 drops by {:.4f}, more than quantize_max_drop {}".format(drop, args.get('quantize_max_drop', 0.01)))
+        return
+    torch.save({'epoch': model.checkpoint_metadata.get('epoch'), 'state_dict': model.state_dict(), 'scores': scores}, quantized_path(save_path))
+    print("Saved the int8 model to {} ({:.1f}x faster than fp32 on the test set)".format(
+        quantized_path(save_path), scores['fp32']['seconds'] / scores['int8']['seconds']))
 
-    print(f"Macro F1 Based: Macro F1: {macro}, Micro F1: {micro}, weighted_f1: {weighted_f1}, jaccard: {jaccard},hamming loss:{hl} and Accuracy: {accuracy}") # Printed model performance metrics.
+
+@torch.no_grad()
+def export(save_path): # Define the export function, which writes the model as an ONNX graph for ONNX Runtime inference.
+
+    model, tokenizer = load_model(save_path) # The PyTorch model, on the CPU.
+    model.eval()
+    path = export_onnx(model, onnx_path(save_path))
+    session = OnnxClassifier(path, num_threads=args.get('onnx_threads'))
+
+    # Parity on the test set: the graph is kept only if its logits match PyTorch's within onnx_tolerance on every batch.
+    test_dataloader = get_dataloader(args['testcsvpath'], tokenizer, train=False)
+    difference, seconds = 0.0, {'torch': 0.0, 'onnx': 0.0}
+    for b_input_ids, b_input_mask, b_labels, b_index in DevicePrefetcher(test_dataloader, device, depth=args.get('prefetch_depth', 2)):
+        logits = {}
+        for backend, run in (('torch', model), ('onnx', session)):
+            start = time.perf_counter()
+            logits[backend] = run(b_input_ids, attention_mask=b_input_mask)
+            seconds[backend] += time.perf_counter() - start
+        difference = max(difference, (logits['torch'] - logits['onnx']).abs().max().item())
+    print("Max abs logit difference {:.3g} on the test set; PyTorch {:.1f}s, ONNX Runtime {:.1f}s".format(difference, seconds['torch'], seconds['onnx']))
+
+    if difference > args.get('onnx_tolerance', 1e-3):
+        os.remove(path)
+        print("Removed {}: logits differ from PyTorch by more than onnx_tolerance {}".format(path, args.get('onnx_tolerance', 1e-3)))
+        return
+    print("Saved the ONNX model to {}".format(path))
 
 
 def metric_calculation(y_true, y_pred): # Define the metric_calculation function to calculate the evaluation metrics.
@@ -410,7 +590,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-args', help="priority", type=bool, required=False, default=True)
     parser.add_argument('-config', help="configuration file *.yml", type=str, required=False, default='/data/0WYJ/newdata_wyj/CMLTES_codes/experiment/CBloss_bigbird_GLEE_atten_kernel_2_3/config.yml')
-    parser.add_argument('-mode', help="train&test", type=str, required=False, default='test')
+    parser.add_argument('-mode', help="train&test&quantize&export_onnx", type=str, required=False, default='test')
     parser.add_argument('-scale', help="large/small", type=str, required=True, default='large')
     args = parser.parse_args()
     
@@ -424,16 +604,9 @@ if __name__ == "__main__":
         opt.update(args)
         args = opt
 
-    df = pd.read_csv(args['traincsvpath']) # Read the traincsvpath file.
-    args['num_samples'] = len(df) # Define the num_samples variable.
-    df_val = pd.read_csv(args['valcsvpath'])
-    args['num_samples_val'] = len(df_val)
-    df_test = pd.read_csv(args['testcsvpath'])
-    args['num_samples_test'] = len(df_test)
     args['model_save_dir'] =  os.path.join(args['filename'], 'models', args['modelname'], str(args['batch_size'])) 
     
     if args['scale'] == "large":
-        args['class_freq'] = [53262, 204846, 10478, 164656, 218, 5246, 230499, 188900]
         args['ckpt_path'] = args['model_save_dir'] + '/best_macro_model_att_large.pt'
 
         args['traincsvpath'] = '/data/0WYJ/newdata_wyj/CMLTES_codes/data/large_dataset_with_label/trainset.csv' # Defines the traincsvpath variable.
@@ -441,7 +614,6 @@ if __name__ == "__main__":
         args['testcsvpath'] = '/data/0WYJ/newdata_wyj/CMLTES_codes/data/large_dataset_with_label/testset.csv' # Defines the testcsvpath variable.
 
     elif args['scale'] == "small":
-        args['class_freq'] = [3839, 12747, 745, 9243, 4, 163, 13745, 12088]  # Number of samples in each category in the dataset
         args['ckpt_path'] = args['model_save_dir'] + '/best_macro_model_att_small.pt'
 
         args['traincsvpath'] = '/data/0WYJ/newdata_wyj/CMLTES_codes/data/small_with_label/small_transfer_trainset_label_chinese.csv' # Defines the traincsvpath variable.
@@ -451,6 +623,18 @@ if __name__ == "__main__":
     args['d_model'] = 512
     args['d_ff'] = 2048   
 
+    # Row counts and class frequencies come from one streaming pass per split, cached in a <csv>.manifest.json sidecar.
+    if args['mode'] == 'train':
+        train_manifest = load_manifest(args['traincsvpath'], args.get('label_vocab', LABEL_VOCAB))
+        args['num_samples'] = train_manifest['rows'] # Define the num_samples variable.
+        args['class_freq'] = train_manifest['label_freq'] # Number of samples in each category in the training set.
+        args['num_samples_val'] = load_manifest(args['valcsvpath'], args.get('label_vocab', LABEL_VOCAB))['rows']
+    elif args['mode'] in ('test', 'quantize', 'export_onnx'):
+        args['num_samples_test'] = load_manifest(args['testcsvpath'], args.get('label_vocab', LABEL_VOCAB))['rows'] # The training set is never read in test mode.
+
+    if args['mode'] in ('quantize', 'export_onnx') or args.get('quantized') or args.get('inference_backend') == 'onnx':
+        device = torch.device('cpu') # Dynamically quantized Linears and the ONNX Runtime backend only run on the CPU.
+
     if not os.path.exists(args['model_save_dir']): 
         os.makedirs(args['model_save_dir']) 
 
@@ -458,4 +642,10 @@ if __name__ == "__main__":
         main(args)
         
     elif args['mode'] == 'test':
-        test(args['ckpt_path'])
\ No newline at end of file
+        test(args['ckpt_path'])
+
+    elif args['mode'] == 'quantize':
+        quantize(args['ckpt_path'])
+
+    elif args['mode'] == 'export_onnx':
+        export(args['ckpt_path'])
\ No newline at end of file
@@ -0,0 +1,73 @@
+# ONNX export and ONNX Runtime inference for the GLEE classifiers.
+#
+# export_onnx traces BertCNNClassifier or BertCNNClassifier_att end to end (backbone, the hook-accumulated layer mix,
+# the conv/pooling head, the attention head and the classifier MLP) into one graph whose batch and sequence axes are
+# dynamic. OnnxClassifier runs that graph with ONNX Runtime on the CPU and is called like the torch model, taking and
+# returning tensors, so test() and the benchmarks use either one unchanged.
+
+import inspect
+import os
+
+import numpy as np
+import torch
+
+ONNX_SUFFIX = '.onnx'
+INPUT_NAMES = ['input_ids', 'attention_mask']
+DYNAMIC_AXES = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'logits': {0: 'batch'}}
+
+
+def onnx_path(path):
+    """Path of the ONNX graph that -mode export_onnx writes for a .pt checkpoint path."""
+    return os.path.splitext(path)[0] + ONNX_SUFFIX
+
+
+def export_onnx(model, path, opset_version=14, seq_len=16):
+    """Export model to path with dynamic batch and sequence axes; returns path.
+
+    The graph is traced, so control flow is fixed at export time: only the
+    plain encode path of BertCNNClassifier_att is exported, not packing or
+    sliding windows, whose branches depend on the input.
+    """
+    if getattr(model, 'packing', False) or getattr(model, 'window_size', None):
+        raise ValueError('packing and sliding windows cannot be exported, their control flow depends on the input')
+    model.eval()
+    device = next(model.parameters()).device
+    input_ids = torch.ones(2, seq_len, dtype=torch.long, device=device)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, seq_len // 2:] = 0  # A padded row, so the masking ops are traced with a real mask.
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False  # The TorchScript exporter, the only one on torch 1.x.
+    with torch.no_grad():
+        torch.onnx.export(model, (input_ids, attention_mask), path, input_names=INPUT_NAMES, output_names=['logits'],
+                          dynamic_axes=DYNAMIC_AXES, opset_version=opset_version, do_constant_folding=True, **kwargs)
+    return path
+
+
+class OnnxClassifier:
+    """An exported graph run with ONNX Runtime on the CPU, called like the torch model."""
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError('the ONNX Runtime backend needs the onnxruntime package (onnxruntime=1.12.1 in requirements.txt)') from error
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.checkpoint_metadata = {}
+
+    def to(self, device):
+        return self  # Always on the CPU; logits come back as CPU tensors.
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        feed = {name: tensor.cpu().numpy().astype(np.int64) for name, tensor in zip(INPUT_NAMES, (input_ids, attention_mask))}
+        logits, = self.session.run(None, feed)
+        return torch.from_numpy(logits)
@@ -1,4 +1,5 @@
 import pandas as pd
+from util_io import read_table
 
 
 # Read data
@@ -12,7 +13,7 @@ import pandas as pd
 # file_path = "/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples_score/shaanxi_dtfry_score.csv"
 file_path = "/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples_score/zj_xt_score.csv"
 
-df = pd.read_csv(file_path)
+df = read_table(file_path, columns=['BMscore', 'Excscore', 'Hygscore', 'PTscore', 'REPscore', 'TSAscore', 'TSHscore', 'TTscore'])
 
 # Calculate the average of each column
 avg_scores = {
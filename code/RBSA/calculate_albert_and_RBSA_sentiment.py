@@ -1,4 +1,5 @@
 import pandas as pd
+from util_io import read_table
 
 
 
@@ -36,8 +37,9 @@ output_files = [
 # Loop through each file pair
 for score_file, sentiment_file, output_file in zip(score_files, sentiment_files, output_files):
     # Read sentiment score file and score file
-    score_df = pd.read_csv(score_file)
-    sentiment_df = pd.read_csv(sentiment_file)
+    # Only the columns used below are loaded; CSV, Parquet and Arrow files are all accepted.
+    score_df = read_table(score_file, columns=['description', 'BMscore', 'Excscore', 'Hygscore', 'PTscore', 'REPscore', 'TSAscore', 'TSHscore', 'TTscore'])
+    sentiment_df = read_table(sentiment_file, columns=['sentiment'])
 
     # Extract necessary columns
     description_column = score_df['description']
@@ -69,8 +69,8 @@
 # If both values are negative, label as negative and take the average score.
 # If one is positive and one is negative, use the value with the higher absolute value as the score and label based on its sign.
 import os
-import pandas as pd
 import ast
+from util_io import read_table
 
 # Define lists of input and output file paths
 input_files = [
@@ -96,7 +96,7 @@ output_files = [
 # Loop through each file to calculate the final sentiment score
 for input_file, output_file in zip(input_files, output_files):
     # Read data
-    df = pd.read_csv(input_file)
+    df = read_table(input_file, columns=['description', 'sentiment'])
 
     # Create a new list to store the calculated sentiment scores
     final_sentiments = []
@@ -146,6 +146,7 @@
 #4. Calculate each row in the test dataset with all rows in the reference dataset
 import pandas as pd
 from transformers import AutoTokenizer, AutoModel
+from util_io import read_table
 from torch.nn import CosineSimilarity
 import torch
 import os
@@ -180,7 +181,7 @@ for prefix in reference_prefixes:
     total_embedding = 0
     total_weight = 0
     for i in range(1, 3):
-        ref_df = pd.read_csv(f"/data/0WYJ/newdata_wyj/CMLTES_codes/reference_test/reference_{prefix}_sentiment_4_{i}.csv")
+        ref_df = read_table(f"/data/0WYJ/newdata_wyj/CMLTES_codes/reference_test/reference_{prefix}_sentiment_4_{i}.csv", columns=['description', 'score'])
         for _, row in ref_df.iterrows():
             embedding = get_embedding(row['description'], model, tokenizer)
             total_embedding += embedding * row['score']
@@ -195,7 +196,7 @@ for prefix in reference_prefixes:
 # test_df = pd.read_csv("/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples/hb_sxrj.csv")
 # test_df = pd.read_csv("/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples/jilin_changying.csv")
 # test_df = pd.read_csv("/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples/shaanxi_dtfry.csv")
-test_df = pd.read_csv("/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples/zj_xt.csv")
+test_df = read_table("/data/0WYJ/newdata_wyj/CMLTES_codes/data/score_test/test_samples/zj_xt.csv", columns=['description'])
 
 
 
@@ -0,0 +1,14 @@
+import os
+
+import pandas as pd
+
+
+def read_table(path, columns=None):
+    """Read a CSV, Parquet or Arrow IPC/Feather file into a DataFrame, loading only the given columns."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.parquet', '.pq'):
+        return pd.read_parquet(path, columns=columns)
+    if ext in ('.arrow', '.feather', '.ipc'):
+        import pyarrow.feather as feather
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
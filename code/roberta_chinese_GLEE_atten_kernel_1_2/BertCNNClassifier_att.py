@@ -1,22 +1,43 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformers import AutoModel
+from transformers import AutoModel, AutoConfig
+try:  # Skips the random initialisation of a backbone whose weights are all loaded from a checkpoint afterwards.
+    from transformers.modeling_utils import no_init_weights
+except ImportError:
+    try:
+        from transformers.initialization import no_init_weights
+    except ImportError:
+        from contextlib import nullcontext as no_init_weights
 import math
+import inspect
+import functools
 
 
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, h=8, n_hidden=768, dropout=0.1):
+    def __init__(self, h=8, n_hidden=768, dropout=0.1, keep_attn=False):
         "Take in model size and number of heads."
         super(MultiHeadedAttention, self).__init__()
         assert n_hidden % h == 0
         # We assume d_v always equals d_k
         self.d_k = n_hidden // h
         self.h = h
-        self.linears = nn.ModuleList([nn.Linear(n_hidden, n_hidden) for _ in range(4)])
+        # Query, key and value projections packed into one [3 * 768, 768] weight, then the output projection;
+        # checkpoints saved with the former linears.0-3 are remapped in _load_from_state_dict.
+        self.qkv = nn.Linear(n_hidden, 3 * n_hidden)
+        self.out = nn.Linear(n_hidden, n_hidden)
+        # The attention weights are only kept in self.attn on request, as they hold on to [4, 8, 512, 512] per call.
+        self.keep_attn = keep_attn
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if prefix + 'linears.0.weight' in state_dict:
+            for name in ('weight', 'bias'):
+                state_dict[prefix + 'qkv.' + name] = torch.cat([state_dict.pop('{}linears.{}.{}'.format(prefix, i, name)) for i in range(3)])
+                state_dict[prefix + 'out.' + name] = state_dict.pop('{}linears.3.{}'.format(prefix, name))
+        super(MultiHeadedAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def attention(self, query, key, value, mask=None, dropout=None):
         "Compute 'Scaled Dot Product Attention'"
         d_k = query.size(-1)
@@ -29,7 +50,39 @@ class MultiHeadedAttention(nn.Module):
             p_attn = dropout(p_attn)
         return torch.matmul(p_attn, value), p_attn
 
+    def project(self, query, key, value):
+        "Query, key and value projections; inputs that are the same tensor share one matrix product."
+        n_hidden = self.out.in_features
+        weight, bias = self.qkv.weight, self.qkv.bias
+        if query is key and key is value:
+            return self.qkv(query).chunk(3, dim=-1)
+        query = F.linear(query, weight[:n_hidden], bias[:n_hidden])
+        if key is value:
+            key, value = F.linear(key, weight[n_hidden:], bias[n_hidden:]).chunk(2, dim=-1)
+        else:
+            key = F.linear(key, weight[n_hidden:2 * n_hidden], bias[n_hidden:2 * n_hidden])
+            value = F.linear(value, weight[2 * n_hidden:], bias[2 * n_hidden:])
+        return query, key, value
+
+    def single_key(self, query, value):
+        "Closed form for a single key: the softmax over one score is 1, so every head returns its value projection."
+        residual, nbatches = query, query.size(0)
+        n_hidden = self.out.in_features
+        value = F.linear(value, self.qkv.weight[2 * n_hidden:], self.qkv.bias[2 * n_hidden:]).view(nbatches, -1, self.h, self.d_k)  # [4, 1, 8, 96]
+        p_attn = value.new_ones(nbatches, self.h, 1, 1)
+        if self.training:
+            p_attn = self.dropout(p_attn)  # Same dropout draws as on the full attention weights.
+            value = value * p_attn.transpose(1, 2)
+        self.attn = p_attn if self.keep_attn else None
+        x = value.view(nbatches, -1, self.h * self.d_k)  # [4, 1, 768]
+        # x + residual broadcasts exactly as in forward ([4, 1, 768] + [4, 768] -> [4, 4, 768] for 2D inputs); the
+        # output projection is affine, so it is applied to both terms before the broadcast instead of after it.
+        return self.out(x) + F.linear(residual, self.out.weight)
+
     def forward(self, query, key, value, mask=None):
+        if key.dim() == 2 or key.size(-2) == 1:
+            # One key per query ([4, 768] inputs from the GLEE head): Q, K, the scores and the mask drop out.
+            return self.single_key(query, value)
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)
@@ -37,81 +90,308 @@ class MultiHeadedAttention(nn.Module):
 
         # 1) Do all the linear projections in batch from n_hidden => h x d_k
         query, key, value = \
-            [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
+            [x.view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+             for x in self.project(query, key, value)]
 
-        # 2) Apply attention on all the projected vectors in batch.
-        x, self.attn = self.attention(query, key, value, mask=mask, dropout=self.dropout)
+        # 2) Apply attention on all the projected vectors in batch: the fused kernel where torch has it (2.0+),
+        # the explicit softmax when the attention weights are to be kept.
+        if self.keep_attn or not hasattr(F, 'scaled_dot_product_attention'):
+            x, p_attn = self.attention(query, key, value, mask=mask, dropout=self.dropout)
+            self.attn = p_attn if self.keep_attn else None
+        else:
+            if mask is not None:
+                mask = torch.zeros(mask.shape, dtype=query.dtype, device=query.device).masked_fill(mask == 0, -1e9)
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=self.dropout.p if self.training else 0.0)
 
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous() \
             .view(nbatches, -1, self.h * self.d_k)
-        return self.linears[-1](x + residual)  # Here the two dimensions are required to be the same
+        return self.out(x + residual)  # Here the two dimensions are required to be the same
+
 
+class FusedLayerNorm(nn.Module):
+    '''
+    The classifier LayerNorm with nn.LayerNorm-style weight / bias names, and optionally one native F.layer_norm call.
+    By default it computes exactly the unbiased-std semantics of the former LayerNorm, a_2 * (x - mean) / (std + eps)
+    + b_2, which the native op cannot express; that path is the same chain of elementwise ops and gives no speedup.
+    standard=True runs the single F.layer_norm call with plain nn.LayerNorm semantics (biased variance, eps in the
+    square root) instead: eps aside, it scales every normalized activation weight * (x - mean) / std by
+    sqrt(n / (n - 1)), 0.25% for the 200-wide classifier, and no logit moves by more than |W| @ that change.
+    Checkpoints saved with LayerNorm (a_2, b_2) are remapped in _load_from_state_dict.
+    '''
 
-class LayerNorm(nn.Module):
-    
-    def __init__(self, features, eps=1e-6):
-        super(LayerNorm, self).__init__()
-        self.a_2 = nn.Parameter(torch.ones(features))
-        self.b_2 = nn.Parameter(torch.zeros(features))
+    def __init__(self, features, eps=1e-6, standard=False):
+        super(FusedLayerNorm, self).__init__()
+        self.weight = nn.Parameter(torch.ones(features))
+        self.bias = nn.Parameter(torch.zeros(features))
         self.eps = eps
+        self.standard = standard
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for old, new in (('a_2', 'weight'), ('b_2', 'bias')):
+            if prefix + old in state_dict:
+                state_dict[prefix + new] = state_dict.pop(prefix + old)
+        super(FusedLayerNorm, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
+        if self.standard:
+            features = self.weight.numel()  # A Python int, also when traced for ONNX export.
+            return F.layer_norm(x, (features,), self.weight, self.bias, self.eps)
         mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        std = x.std(-1, unbiased=True, keepdim=True)
+        return self.weight * (x - mean) / (std + self.eps) + self.bias
+
+
+def capturing_graph():
+    # True while torch.jit.trace (also under ONNX export) or torch.compile records a graph, which needs static shapes.
+    if torch.jit.is_tracing():
+        return True
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)
+    return bool(is_compiling and is_compiling())
+
+
+def fused_conv_pool(x, mask, convs):
+    '''
+    Run Conv1d layers that differ only in kernel size as one matrix product, then ReLU and max/mean pool the output of
+    every kernel over the positions it produces on the unpadded sequence, so padding never enters the features.
+    Padding past the longest review of the batch is also cut off before the product, so it costs no FLOPs here; the
+    shorter reviews still compute up to that length, and the backbone runs over the whole padded batch (dynamic
+    padding keeps that short). The cut reads the longest length back from the device, and is left out while a graph
+    is traced or compiled, where the shapes must not depend on the data.
+    x: [4, 768, 512]
+    mask: [4, 512], 1 for real tokens (padding at the end), or None when nothing is padded
+    convs: Conv1d layers with the same in_channels and padding
+    Returns one (max, mean) pair of [4, 256] features per conv.
+    '''
+    padding = convs[0].padding[0]
+    if mask is not None:
+        if not capturing_graph():
+            longest = max(int(mask.sum(dim=1).max()), 1)
+            x, mask = x[:, :, :longest], mask[:, :longest]
+        x = x * mask[:, None, :].to(x.dtype)  # Padding tokens read as zeros, like the conv's own padding.
+    # Every tap of every kernel in one product: [4, (1 + 2) * 256, 514], zero at the conv padding positions;
+    # a kernel's output is the sum of its taps shifted by their offsets, so no FLOPs go to zero-extended kernels.
+    taps = torch.cat([conv.weight.permute(2, 0, 1).reshape(-1, conv.in_channels) for conv in convs], dim=0)
+    projected = torch.matmul(taps, F.pad(x, (padding, padding)))
+
+    seq_len = projected.size(2)
+    lengths = mask.sum(dim=1) if mask is not None else torch.full((x.size(0),), x.size(2), device=x.device)
+    positions = torch.arange(seq_len, device=x.device)
+    pooled, row = [], 0
+    for conv in convs:
+        k, out_channels = conv.kernel_size[0], conv.out_channels
+        out_len = seq_len - k + 1
+        local_feature = projected[:, row:row + out_channels, :out_len] + conv.bias[None, :, None]
+        for t in range(1, k):
+            local_feature.add_(projected[:, row + t * out_channels:row + (t + 1) * out_channels, t:t + out_len])
+        row += k * out_channels
+
+        num_valid = lengths + 2 * padding - k + 1  # Output positions of this kernel on the unpadded review.
+        valid = (positions[None, :out_len] < num_valid[:, None]).to(local_feature.dtype)[:, None, :]
+        # Zeroed before the ReLU, so positions past the review are 0 and never win the max.
+        local_feature = F.relu(local_feature.mul_(valid))  # [4, 256, 514 - k]
+        pooled.append((local_feature.max(dim=2)[0], local_feature.sum(dim=2) / num_valid.clamp(min=1)[:, None].to(local_feature.dtype)))
+    return pooled
+
+
+def quantize_int8(model):
+    '''
+    Dynamic int8 quantization of a BertCNNClassifier_att for CPU inference, in place: the nn.Linear layers of the
+    backbone, local_fc and the classifier MLP get int8 weights and quantize their inputs on the fly. The attention
+    head stays fp32, as MultiHeadedAttention slices its packed qkv weight directly, and so do the embeddings.
+    '''
+    qconfig = torch.quantization.default_dynamic_qconfig
+    linear = {nn.Linear: torch.quantization.get_default_dynamic_quant_module_mappings()[nn.Linear]}
+    return torch.quantization.quantize_dynamic(model, {'bert': qconfig, 'local_fc': qconfig, 'classifier': qconfig},
+                                               dtype=torch.qint8, mapping=linear, inplace=True)
 
 
 class BertCNNClassifier_att(nn.Module):
-    def __init__(self, num_labels, mlp_size, bert_output_dim=768, conv_out_channels=256, kernel_sizes=[1, 2], d_model=768, d_k=96, d_v=96, n_heads=8):
+    def __init__(self, num_labels, mlp_size, bert_output_dim=768, conv_out_channels=256, kernel_sizes=[1, 2], d_model=768, d_k=96, d_v=96, n_heads=8, window_size=None, window_stride=None, packing=False, keep_attn=False, standard_layer_norm=False, pretrained=True):
         super(BertCNNClassifier_att, self).__init__()
         BERT_CHI_EXT_dir = '/data/0WYJ/newdata_wyj/CMLTES_codes/multi_class/ROBERTA_RRE_LARGE'
-        self.bert = AutoModel.from_pretrained(BERT_CHI_EXT_dir)
+        if pretrained:
+            self.bert = AutoModel.from_pretrained(BERT_CHI_EXT_dir)
+        else:
+            # Architecture from config.json only, for restoring a checkpoint that holds every weight anyway.
+            with no_init_weights():
+                self.bert = AutoModel.from_config(AutoConfig.from_pretrained(BERT_CHI_EXT_dir))
 
         self.n_heads = n_heads
+        # Optional sliding-window encoding: reviews longer than window_size are cut into overlapping
+        # windows of [CLS] + (window_size - 1) tokens that advance by window_stride tokens.
+        self.window_size = window_size
+        self.window_stride = window_stride or (window_size - 1) // 2 if window_size else None
+        # Optional packing: several short reviews share one sequence, and attention_mask holds the segment number
+        # (1, 2, ...) of every token instead of 0/1; see encode_packed.
+        self.packing = packing
+        if packing and window_size:
+            raise ValueError('packing and sliding windows cannot be combined')
+        if packing and getattr(self.bert.config, 'attention_type', None) == 'block_sparse':
+            self.bert.set_attention_type('original_full')  # Block-sparse attention only takes a 2D padding mask.
+        self.bert_position_ids = 'position_ids' in inspect.signature(self.bert.forward).parameters
         self.conv1 = nn.Conv1d(in_channels=bert_output_dim, out_channels=conv_out_channels, kernel_size=kernel_sizes[0], padding=1)
         self.conv2 = nn.Conv1d(in_channels=bert_output_dim, out_channels=conv_out_channels, kernel_size=kernel_sizes[1], padding=1)
         
         self.num_bert_layers = 13  # Include the initial embedding layer + transformer layer, the total number of layers in the BERT model is 13
         self.layer_weights = nn.Parameter(torch.ones(self.num_bert_layers) / self.num_bert_layers)
+        # The layer-weighted sum is accumulated by hooks while the encoder runs (see weighted_hidden).
+        self._mixing = False
+        self._mixed = None
+        encoder_layers = self.bert.encoder.layer
+        encoder_layers[0].register_forward_pre_hook(self._mix_embeddings)
+        for i, layer in enumerate(encoder_layers):
+            layer.register_forward_hook(functools.partial(self._mix_layer, i + 1))
 
-        self.attention_global = MultiHeadedAttention(n_heads, d_model)
-        self.attention_local = MultiHeadedAttention(n_heads, d_model)
+        self.attention_global = MultiHeadedAttention(n_heads, d_model, keep_attn=keep_attn)
+        self.attention_local = MultiHeadedAttention(n_heads, d_model, keep_attn=keep_attn)
         
         self.local_fc = nn.Linear(in_features=2 * 2 * conv_out_channels, out_features=bert_output_dim)
 
         self.classifier = nn.Sequential(
             nn.Linear(in_features=1536, out_features=mlp_size),
-            LayerNorm(mlp_size),
+            FusedLayerNorm(mlp_size, standard=standard_layer_norm),
             nn.ReLU(),
             nn.Dropout(0.1),
             nn.Linear(in_features=mlp_size, out_features=num_labels)
         )
 
-    def forward(self, input_ids, attention_mask=None):
+    def encode(self, input_ids, attention_mask=None):
         '''
         input_ids: [4, 512]
         attention_mask: [4, 512]
+        Returns the [CLS] global feature and the max/avg pooled conv features of each sequence.
         '''
-        # BERT global feature extraction using multi-layer outputs
-        bert_outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
-        hidden_states = bert_outputs.hidden_states  # 
-        weighted_hidden_states = torch.stack(hidden_states, dim=0) * self.layer_weights.view(-1, 1, 1, 1) # [13, 4, 512, 768]
-        weighted_sum = torch.sum(weighted_hidden_states, dim=0)  # [4, 512, 768]
+        return self.pool(self.weighted_hidden(input_ids, attention_mask), attention_mask)
+
+    def weighted_hidden(self, input_ids, attention_mask=None, **kwargs):
+        # BERT global feature extraction using multi-layer outputs.
+        # Same as summing layer_weights[i] * hidden_states[i] over output_hidden_states=True, but the hooks add each
+        # of the 13 layers to a running sum as it is produced, so no [13, 4, 512, 768] stack is ever built.
+        self._mixing = True
+        try:
+            self.bert(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+            return self._mixed  # [4, 512, 768]
+        finally:
+            self._mixing = False
+            self._mixed = None
+
+    def _mix_embeddings(self, layer, inputs):
+        # hidden_states[0]: the embedding output entering the first encoder layer.
+        if self._mixing:
+            self._mixed = inputs[0] * self.layer_weights[0]
+
+    def _mix_layer(self, index, layer, inputs, output):
+        # hidden_states[index]: the output of encoder layer index - 1.
+        if self._mixing:
+            hidden = output[0] if isinstance(output, tuple) else output
+            self._mixed = self._mixed + hidden * self.layer_weights[index]
+
+    def pool(self, weighted_sum, attention_mask=None):
         global_feature = weighted_sum[:, 0, :] # Take the [CLS]-tagged output as the global representation of the sentence [4, 768]
         
         conv_input = weighted_sum.permute(0, 2, 1) ## Adjusts the dimensionality of the BERT output to match the input requirements of the convolutional layer Variable in terms of weighted_sum, originally 0, 1, 2 becomes 0, 2, 1 [4, 768, 512]
 
-        local_feature1 = F.relu(self.conv1(conv_input))  # [4, 256, 513]
-        local_feature2 = F.relu(self.conv2(conv_input))  # [4, 256, 512]
+        # Both kernel sizes in one pass; max and mean pooling only see the positions of real tokens,
+        # so a review gets the same features however far its batch is padded.
+        (local_feature1_max, local_feature1_avg), (local_feature2_max, local_feature2_avg) = \
+            fused_conv_pool(conv_input, attention_mask, (self.conv1, self.conv2))  # [4, 256] each
+
+        return global_feature, (local_feature1_max, local_feature1_avg, local_feature2_max, local_feature2_avg)
+
+    def split_windows(self, input_ids, attention_mask):
+        '''
+        Cut every sequence after its [CLS] into overlapping windows and prefix each window with that [CLS].
+        Returns the kept windows of all reviews as one batch [n_windows, window_size] and a [batch, windows_per_review]
+        mask telling which windows were kept; windows that hold only padding are dropped, the first one never is.
+        '''
+        seq_len = input_ids.size(1)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        body, stride = self.window_size - 1, self.window_stride
+        num_windows = -(-(seq_len - 1 - body) // stride) + 1
+        pad = (num_windows - 1) * stride + body - (seq_len - 1)
+
+        content_ids = F.pad(input_ids[:, 1:], (0, pad)).unfold(1, body, stride)  # [4, n, window_size - 1]
+        content_mask = F.pad(attention_mask[:, 1:], (0, pad)).unfold(1, body, stride)
+        cls_ids = input_ids[:, :1, None].expand(-1, num_windows, 1)
+        cls_mask = attention_mask[:, :1, None].expand(-1, num_windows, 1)
+        window_ids = torch.cat((cls_ids, content_ids), dim=2)  # [4, n, window_size]
+        window_mask = torch.cat((cls_mask, content_mask), dim=2)
+
+        kept = content_mask.bool().any(dim=2)
+        kept[:, 0] = True
+        return window_ids[kept], window_mask[kept], kept
+
+    def encode_windows(self, input_ids, attention_mask=None):
+        '''
+        Encode all windows of the batch in one backbone call and aggregate them back per review:
+        the global feature is the mean of the window [CLS] features, max-pooled conv features take the max over
+        windows and avg-pooled ones the mean over windows.
+        '''
+        window_ids, window_mask, kept = self.split_windows(input_ids, attention_mask)
+        window_global, window_locals = self.encode(window_ids, attention_mask=window_mask)
+
+        counts = kept.sum(dim=1, keepdim=True).to(window_global.dtype)  # [4, 1]
+
+        def mean_over_windows(x):
+            dense = x.new_zeros(kept.shape + x.shape[1:])
+            dense[kept] = x
+            return dense.sum(dim=1) / counts
+
+        def max_over_windows(x):
+            dense = x.new_full(kept.shape + x.shape[1:], float('-inf'))
+            dense[kept] = x
+            return dense.max(dim=1)[0]
+
+        global_feature = mean_over_windows(window_global)
+        local_feature1_max, local_feature1_avg, local_feature2_max, local_feature2_avg = window_locals
+        return global_feature, (max_over_windows(local_feature1_max), mean_over_windows(local_feature1_avg),
+                                max_over_windows(local_feature2_max), mean_over_windows(local_feature2_avg))
 
-        local_feature1_max = F.max_pool1d(local_feature1, kernel_size=local_feature1.size(2)).squeeze(2) # [4, 256]
-        local_feature1_avg = F.avg_pool1d(local_feature1, kernel_size=local_feature1.size(2)).squeeze(2) # [4, 256]
-        local_feature2_max = F.max_pool1d(local_feature2, kernel_size=local_feature2.size(2)).squeeze(2) # [4, 256]
-        local_feature2_avg = F.avg_pool1d(local_feature2, kernel_size=local_feature2.size(2)).squeeze(2) # [4, 256]
+    def encode_packed(self, input_ids, segment_ids):
+        '''
+        input_ids: [2, 512] packed sequences, each the concatenation of several reviews ([CLS] ... [SEP] each)
+        segment_ids: [2, 512] segment number of every token, 1 for the first review of a sequence, 0 for padding
+        Attention is block-diagonal, positions restart at every review, and the [CLS] and conv features are taken
+        per review, so every review gets its own row; rows follow sequence order, then segment order.
+        '''
+        packs, seq_len = segment_ids.shape
+        positions = torch.arange(seq_len, device=segment_ids.device).expand(packs, -1)
+        previous = F.pad(segment_ids[:, :-1], (1, 0))
+        starts = (segment_ids != previous) & (segment_ids > 0)  # First token of every review.
+
+        # Tokens attend only within their own review: [2, 512, 512], accepted as a 3D mask by the backbone.
+        attention_mask = ((segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)).long()
+        kwargs = {}
+        if self.bert_position_ids:  # Absolute position embeddings restart at 0 for every review; rotary ones are relative already.
+            kwargs['position_ids'] = positions - torch.where(starts, positions, torch.zeros_like(positions)).cummax(dim=1)[0]
+        weighted_sum = self.weighted_hidden(input_ids, attention_mask, **kwargs)  # [2, 512, 768]
+
+        # Gather every review into its own zero-padded row: [n_reviews, longest_review, 768].
+        pack_index, start = starts.nonzero(as_tuple=True)
+        lengths = torch.zeros(packs, seq_len + 1, dtype=torch.long, device=segment_ids.device)
+        lengths = lengths.scatter_add_(1, segment_ids, torch.ones_like(segment_ids))[:, 1:]
+        lengths = lengths[lengths > 0]
+        offsets = torch.arange(int(lengths.max()), device=segment_ids.device)
+        valid = offsets[None, :] < lengths[:, None]
+        token = (start[:, None] + offsets[None, :]).clamp(max=seq_len - 1)
+        reviews = weighted_sum[pack_index[:, None], token] * valid[:, :, None].to(weighted_sum.dtype)
+        return self.pool(reviews, valid.long())
+
+    def forward(self, input_ids, attention_mask=None):
+        '''
+        input_ids: [4, 512]
+        attention_mask: [4, 512]
+        '''
+        if self.packing:
+            global_feature, pooled = self.encode_packed(input_ids, attention_mask)
+        elif self.window_size and input_ids.size(1) > self.window_size:
+            global_feature, pooled = self.encode_windows(input_ids, attention_mask)
+        else:
+            global_feature, pooled = self.encode(input_ids, attention_mask)
 
-        local_features = torch.cat((local_feature1_max, local_feature1_avg, local_feature2_max, local_feature2_avg), 1)  # [4,1024]
+        local_features = torch.cat(pooled, 1)  # [4,1024]
 
         local_features = self.local_fc(local_features)  # [4, 768]
 
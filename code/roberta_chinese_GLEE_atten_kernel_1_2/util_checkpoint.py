@@ -0,0 +1,82 @@
+# Checkpoint files of the GLEE classifiers.
+#
+# A checkpoint is either the pickled {'epoch', 'state_dict'} dict written by torch.save, or a safetensors file whose
+# header carries the metadata (epoch, variant, kernel sizes, threshold, ...) next to the tensor offsets. Safetensors
+# files are memory-mapped when loaded: only the header is parsed up front, tensors are paged in when they are used,
+# and processes that load the same checkpoint on one host share its pages in the page cache.
+
+import inspect
+import json
+import os
+
+import torch
+
+SAFETENSORS_SUFFIX = '.safetensors'
+DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def checkpoint_path(path, checkpoint_format='torch'):
+    """Checkpoint file for a .pt path: the path itself, or its .safetensors sibling."""
+    if checkpoint_format == 'safetensors':
+        return os.path.splitext(path)[0] + SAFETENSORS_SUFFIX
+    return path
+
+
+def quantized_path(path):
+    """Path of the int8 model that -mode quantize writes for a .pt checkpoint path."""
+    return os.path.splitext(path)[0] + '_int8.pt'
+
+
+def save_checkpoint(path, state_dict, metadata=None, dtype=None):
+    """Write state_dict as a safetensors file.
+
+    Floating-point tensors are stored as dtype ('float16' or 'bfloat16' halve
+    the file) and cast back to the model's dtype when loaded. metadata values
+    are JSON-encoded, as the header only holds strings.
+    """
+    from safetensors.torch import save_file
+    dtype = DTYPES[dtype] if isinstance(dtype, str) else dtype
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.cpu().contiguous()
+    header = {key: json.dumps(value) for key, value in (metadata or {}).items()}
+    header['dtype'] = json.dumps(str(dtype or torch.float32).replace('torch.', ''))
+    save_file(tensors, path, metadata=header)
+
+
+def load_checkpoint(path, device='cpu'):
+    """Read a checkpoint written by save_checkpoint or torch.save; returns (state_dict, metadata).
+
+    Safetensors tensors come straight from the memory-mapped file (no copy on
+    the CPU, one transfer otherwise) in their stored dtype; a torch.save file is
+    unpickled as a whole and its metadata is just the epoch.
+    """
+    if not path.endswith(SAFETENSORS_SUFFIX):
+        checkpoint = torch.load(path, map_location=device)
+        return checkpoint['state_dict'], {'epoch': checkpoint.get('epoch')}
+    from safetensors import safe_open
+    with safe_open(path, framework='pt', device=str(device)) as f:
+        metadata = {key: json.loads(value) for key, value in (f.metadata() or {}).items()}
+        state_dict = {name: f.get_tensor(name) for name in f.keys()}
+    return state_dict, metadata
+
+
+def load_into(model, path, device='cpu'):
+    """Load a checkpoint into model and return its metadata.
+
+    load_state_dict copies (and casts half-precision weights) into the model's
+    own tensors. On torch 2.1+ a safetensors checkpoint whose dtypes already
+    match is assigned instead, so the parameters are the memory-mapped tensors
+    themselves and loading is zero-copy on the CPU.
+    """
+    state_dict, metadata = load_checkpoint(path, device)
+    kwargs = {}
+    if path.endswith(SAFETENSORS_SUFFIX) and 'assign' in inspect.signature(model.load_state_dict).parameters:
+        own = model.state_dict()
+        if all(name in own and own[name].dtype == tensor.dtype and own[name].device == tensor.device for name, tensor in state_dict.items()):
+            kwargs['assign'] = True
+    model.load_state_dict(state_dict, **kwargs)
+    return metadata
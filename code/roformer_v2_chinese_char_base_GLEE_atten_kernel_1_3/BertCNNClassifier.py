@@ -1,13 +1,26 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from transformers import AutoModel
+from transformers import AutoModel, AutoConfig
+from BertCNNClassifier_att import fused_conv_pool
+try:  # Skips the random initialisation of a backbone whose weights are all loaded from a checkpoint afterwards.
+    from transformers.modeling_utils import no_init_weights
+except ImportError:
+    try:
+        from transformers.initialization import no_init_weights
+    except ImportError:
+        from contextlib import nullcontext as no_init_weights
+import functools
 
 class BertCNNClassifier(nn.Module):
-    def __init__(self, num_labels, mlp_size, bert_output_dim=768, conv_out_channels=256, kernel_sizes=[2, 3]):
+    def __init__(self, num_labels, mlp_size, bert_output_dim=768, conv_out_channels=256, kernel_sizes=[2, 3], pretrained=True):
         super(BertCNNClassifier, self).__init__()
         BERT_CHI_EXT_dir = '/data/0WYJ/newdata_wyj/CMLTES_codes/multi_class/roformer_v2_chinese_char_base'
-        self.bert = AutoModel.from_pretrained(BERT_CHI_EXT_dir)
+        if pretrained:
+            self.bert = AutoModel.from_pretrained(BERT_CHI_EXT_dir)
+        else:
+            # Architecture from config.json only, for restoring a checkpoint that holds every weight anyway.
+            with no_init_weights():
+                self.bert = AutoModel.from_config(AutoConfig.from_pretrained(BERT_CHI_EXT_dir))
 
         # Set up the convolutional layer, here different sized convolutional kernels are used
         self.conv1 = nn.Conv1d(in_channels=bert_output_dim, out_channels=conv_out_channels, kernel_size=kernel_sizes[0], padding=1)
@@ -16,6 +29,13 @@ class BertCNNClassifier(nn.Module):
         # Set weight parameters for global features
         self.num_bert_layers = 13  # Include the initial embedding layer + transformer layer, the total number of layers in the BERT model is 13
         self.layer_weights = nn.Parameter(torch.ones(self.num_bert_layers) / self.num_bert_layers)
+        # The layer-weighted sum is accumulated by hooks while the encoder runs instead of stacking all 13 hidden states.
+        self._mixing = False
+        self._mixed = None
+        encoder_layers = self.bert.encoder.layer
+        encoder_layers[0].register_forward_pre_hook(self._mix_embeddings)
+        for i, layer in enumerate(encoder_layers):
+            layer.register_forward_hook(functools.partial(self._mix_layer, i + 1))
        
         # Set the fully connected layer, where in_features needs to be set according to the number of output features of the convolutional layer
         # Fully connected layer before adding local feature splicing, use local feature dimensions as in_features and bert_output_dim as out_features
@@ -34,13 +54,15 @@ class BertCNNClassifier(nn.Module):
 
     def forward(self, input_ids, attention_mask=None):
         # BERT global feature extraction using multi-layer outputs
-        bert_outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
-        hidden_states = bert_outputs.hidden_states  # Get the output of each layer
-        # print("Hidden states shape:", [x.shape for x in hidden_states])  # Print the shape of each layer 13 different tensors, each of which is [4, 512, 768]
-
-        # Compute weighted summation of global features
-        weighted_hidden_states = torch.stack(hidden_states, dim=0) * self.layer_weights.view(-1, 1, 1, 1) # Reshape the weight tensor into the shape [13, 1, 1, 1] so that it can be multiplied by each element of the hidden state.
-        weighted_sum = torch.sum(weighted_hidden_states, dim=0)  # Sum by layer weights 
+        # Compute weighted summation of global features: the hooks add layer_weights[i] times the output of each of the
+        # 13 layers (each [4, 512, 768]) to a running sum while the encoder runs, so the layers are never stacked.
+        self._mixing = True
+        try:
+            self.bert(input_ids=input_ids, attention_mask=attention_mask)
+            weighted_sum = self._mixed
+        finally:
+            self._mixing = False
+            self._mixed = None
         # print("Weighted sum shape:", weighted_sum.shape)  # Print the shape of the summed weights weighted_sum has the shape [4, 512, 768], which means that the weighted features were summed for each layer.
         global_feature = weighted_sum[:, 0, :] # Take the [CLS] tagged output as the global representation of the sentence
         # print("Global feature shape:", global_feature.shape)  # Print the shape of the global feature global_feature changes shape to [4, 768], indicating that there are 4 samples of global features, each of which is a 768-dimensional vector.
@@ -50,16 +72,11 @@ class BertCNNClassifier(nn.Module):
         conv_input = weighted_sum.permute(0, 2, 1) ## Adjusts the dimensionality of the BERT output to match the input requirements of the convolutional layer Variable in terms of weighted_sum, which was 0, 1, 2 becomes 0, 2, 1
         # print("Conv input shape:", conv_input.shape)  # Print the shape of the convolutional input [4, 768, 512]
 
-        # Local Feature Extraction by Convolutional Layer CNN Local Feature Extraction
-        local_feature1 = F.relu(self.conv1(conv_input))
-        local_feature2 = F.relu(self.conv2(conv_input))
-        # print("Local feature 1 shape:", local_feature1.shape)  # Print the shape of local feature 1 [4, 256, 513]
-        # print("Local feature 2 shape:", local_feature2.shape)  # Print the shape of the local feature 2 [4, 256, 512]
-        # Apply Maximum Pooling and Average Pooling
-        local_feature1_max = F.max_pool1d(local_feature1, kernel_size=local_feature1.size(2)).squeeze(2)
-        local_feature1_avg = F.avg_pool1d(local_feature1, kernel_size=local_feature1.size(2)).squeeze(2)
-        local_feature2_max = F.max_pool1d(local_feature2, kernel_size=local_feature2.size(2)).squeeze(2)
-        local_feature2_avg = F.avg_pool1d(local_feature2, kernel_size=local_feature2.size(2)).squeeze(2)        
+        # Local Feature Extraction by Convolutional Layer CNN Local Feature Extraction, as one fused product of the
+        # two kernels; Maximum Pooling and Average Pooling only cover the positions each kernel produces on the
+        # unpadded review, so the features do not depend on how far the batch is padded (see fused_conv_pool).
+        (local_feature1_max, local_feature1_avg), (local_feature2_max, local_feature2_avg) = \
+            fused_conv_pool(conv_input, attention_mask, (self.conv1, self.conv2))
         # print("Local feature 1 max shape:", local_feature1_max.shape)  # Print the shape of the maximum value of local feature 1 [4, 256]
         # print("Local feature 1 avg shape:", local_feature1_avg.shape)  # Print the shape of the mean value of local feature 1 [4, 256]
         # print("Local feature 2 max shape:", local_feature2_max.shape)  # Print the shape of the maximum value of local feature 2 [4, 256]
@@ -88,3 +105,14 @@ class BertCNNClassifier(nn.Module):
         # print("Logits shape:", logits.shape)  # Print the shape of logits
 
         return logits
+
+    def _mix_embeddings(self, layer, inputs):
+        # hidden_states[0]: the embedding output entering the first encoder layer.
+        if self._mixing:
+            self._mixed = inputs[0] * self.layer_weights[0]
+
+    def _mix_layer(self, index, layer, inputs, output):
+        # hidden_states[index]: the output of encoder layer index - 1.
+        if self._mixing:
+            hidden = output[0] if isinstance(output, tuple) else output
+            self._mixed = self._mixed + hidden * self.layer_weights[index]
@@ -8,7 +8,7 @@ from sklearn.metrics import f1_score, accuracy_score, hamming_loss, classificati
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss, BCEWithLogitsLoss
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from transformers import BertTokenizer, BertConfig, BertForSequenceClassification
 from transformers import AutoTokenizer, AutoModelForSequenceClassification,\
 AdamW, get_linear_schedule_with_warmup
@@ -16,13 +16,13 @@ from sklearn.model_selection import train_test_split
 from BertCNNClassifier import BertCNNClassifier
 from transformers import AutoConfig
 import numpy as np
-import pandas as pd
 import random
 from tqdm import tqdm, trange
 import pdb
 import yaml
 import argparse
 from util_loss import ResampleLoss
+from util_data import read_reviews, load_manifest, TokenizedDataset, TokenBudgetBatchSampler, PadCollator, tokenize_parallel
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -85,7 +85,8 @@ def load_model(save_path):
     '''
     if args['modelname'] == 'roformer_v2_GLEE':
         model = BertCNNClassifier(num_labels=args['num_labels'], mlp_size=args['mlp_size'],
-                              bert_output_dim=768, conv_out_channels=256, kernel_sizes=[2, 3])
+                              bert_output_dim=768, conv_out_channels=256, kernel_sizes=[2, 3],
+                              pretrained=False) # Backbone built from its config only; every weight comes from the checkpoint below.
         model.to(device)
         
         tokenizer_path = '/data/0WYJ/newdata_wyj/CMLTES_codes/multi_class/roformer_v2_chinese_char_base' 
@@ -102,8 +103,8 @@ def get_dataloader(path, tokenizer, train:bool):
     Fetch data according to a given path and pass the data and training flags to the data loader, so that it can be easily loaded from a given path and generate a data loader that
     for subsequent model training and evaluation.
     '''
-    text, labels = get_data(path, tokenizer) # Call the get_data method to load the dataset and store the text data and labels data in the text and labels variables respectively.
-    dataloader = new_dataloader(text, labels, train) # Call the dataloader method to get the data loader and store it in the dataloader variable.
+    data = get_data(path, tokenizer) # Call the get_data method to load and tokenize the dataset.
+    dataloader = new_dataloader(data, train, tokenizer.pad_token_id) # Call the dataloader method to get the data loader and store it in the dataloader variable.
     return dataloader
 
 
@@ -112,35 +113,38 @@ def get_data(path, tokenizer):
     A method named get_data is defined to get the data.
     '''
     text, labels = load_dataset(path) # Call the load_dataset method to load the dataset and store the text data and labels data in the text and labels variables respectively.
-    #text = tokenizer(text, padding=True, truncation=True,  max_length=max_length, return_tensors='pt') 
-    text = tokenizer(text, padding='max_length', truncation=True, return_tensors='pt', max_length=args['max_length']) 
-    text = text.to(device)  # move text to GPU *
-    return text, labels
-
-
-def new_dataloader(text, labels, train:bool): # This code defines a method called dataloader to get the data loader.
-    data = TensorDataset(text['input_ids'], text['attention_mask'], torch.tensor(labels)) 
+    # Rows are stored un-padded on the CPU; PadCollator pads every batch and the loops copy it to the device.
+    ids, offsets = tokenize_parallel(text, tokenizer, args['max_length'], num_proc=args.get('tokenize_workers', 1))
+    return TokenizedDataset(ids, offsets, labels)
+
+
+def new_dataloader(data, train:bool, pad_token_id=0): # This code defines a method called dataloader to get the data loader.
+    if args.get('dynamic_padding'):
+        # Batches of similar-length reviews, each padded only to its own longest member.
+        batch_sampler = TokenBudgetBatchSampler(data.lengths, max_tokens=args.get('max_tokens') or args['batch_size'] * args['max_length'],
+                                                shuffle=train, max_batch_size=args.get('max_batch_size'))
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=PadCollator(pad_token_id))
+    collate_fn = PadCollator(pad_token_id, pad_to=args['max_length']) # Every batch padded to max_length, as before.
     
     if train:
         sampler = RandomSampler(data) # Create a random sampler.
         dataloader = DataLoader(data, # Create a data loader.
                                 sampler=sampler, # A random sampler was used.
-                                batch_size=args['batch_size']) # Set the batch size.
+                                batch_size=args['batch_size'], # Set the batch size.
+                                collate_fn=collate_fn)
     else:
         sampler = SequentialSampler(data) # Creates a sequential sampler.
         dataloader = DataLoader(data, # Create a data loader.
                                 sampler=sampler, # Sequential samplers are used.
-                                batch_size=args['batch_size']) # Set the batch size.
+                                batch_size=args['batch_size'], # Set the batch size.
+                                collate_fn=collate_fn)
         
     return dataloader
 
 def load_dataset(path): # This code defines a method called load_dataset for loading datasets.
-    df = pd.read_csv(path, index_col=False) # Use the pandas library to read the dataset. and store it in the DataFrame object df.
-    text = df['description'].tolist()  # Convert the ‘temp’ column in the DataFrame object df to a list and store it in the text variable.
-    # Here temp stores the text of the original tweet minus the special symbols.
+    # CSV, Parquet or Arrow IPC/Feather; only the description and label1..label8 columns are read.
+    text, label = read_reviews(path)
     # pdb.set_trace() 
-    # label = df[['label1', 'label2', 'label3']].values.tolist() # Converts the columns ‘label1’, ‘label2’, ‘label3’ in the DataFrame object df to a list and stores them in the label variable.
-    label = df[['label1', 'label2', 'label3','label4','label5','label6','label7','label8']].values.tolist() # Converts the columns ‘label1’, ‘label2’, ‘label3’ in the DataFrame object df to a list and stores them in the label variable.
     print(label[0]) # Print the first of the labels
     # print('The before label list is: ', label)
     label = get_one_hot_encode(label) # Call the get_one_hot_encode method to convert the label to one-hot encoded form and store it in the label variable.
@@ -210,8 +214,13 @@ def main(args):
 
     model = model.to(device)  # Move the model to the GPU
 
+    train_dataloader = get_dataloader(args['traincsvpath'], tokenizer, train=True) # Training data loader.
+    valid_dataloader = get_dataloader(args['valcsvpath'], tokenizer, train=False) # Validate the data loader.
+
     # training step
     num_training_steps = args['num_epochs'] * (args['num_samples'] // args['batch_size']) # Total training steps
+    if args.get('dynamic_padding'):
+        num_training_steps = sum(train_dataloader.batch_sampler.plan(args['num_epochs'])) # Token-budget batches of every epoch, drawn ahead.
     
     # Initialise the optimiser and scheduler
     optimizer, scheduler = initialise_optimizer(model, args['learning_rate'], num_training_steps)
@@ -225,9 +234,6 @@ def main(args):
                              class_freq=args['class_freq'], train_num=args['num_samples'])
     
 
-    train_dataloader = get_dataloader(args['traincsvpath'], tokenizer, train=True) # Training data loader.
-    valid_dataloader = get_dataloader(args['valcsvpath'], tokenizer, train=False) # Validate the data loader.
-
     for actual_epoch in trange(args['num_epochs'], desc="Epoch"):
         
         epoch_train_loss = train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch)   
@@ -266,7 +272,7 @@ def train(model, train_dataloader, optimizer, scheduler, loss_func, actual_epoch
         
         batch = tuple(t.to(device) for t in batch) # Move batch data to the GPU.
         
-        b_input_ids, b_input_mask, b_labels = batch # Unpacks batch data into input IDs, input masks, and labels.
+        b_input_ids, b_input_mask, b_labels, _ = batch # Unpacks batch data into input IDs, input masks, labels and row indices.
         # print(f"Input IDs Shape: {b_input_ids.shape}")
         # print(f"Attention Mask Shape: {b_input_mask.shape}")
         # print(f"Labels Shape: {b_labels.shape}")        
@@ -310,7 +316,7 @@ def validate(model, valid_dataloader, loss_func, epoch, threshold=0.5):
     for step, batch in enumerate(valid_dataloader): # Use the enumerate function to iterate through the batch data in the validation data loader.
         
         batch = tuple(t.to(device) for t in batch) # Move batch data to the GPU.
-        b_input_ids, b_input_mask, b_labels = batch # Get batch data.
+        b_input_ids, b_input_mask, b_labels, _ = batch # Get batch data.
         
 
             
@@ -374,7 +380,7 @@ def test(save_path): # Define the test function, which is used to evaluate the m
 
     for idx, batch in enumerate(test_dataloader): # The data loader that traverses the test set.
         batch = tuple(t.to(device) for t in batch) # Moves data to the specified device.
-        b_input_ids, b_input_mask, b_labels = batch # Get input data.
+        b_input_ids, b_input_mask, b_labels, _ = batch # Get input data.
         
         logits = model(b_input_ids, attention_mask=b_input_mask)  # Get logits directly
         pred_label = torch.sigmoid(logits) # Perform a sigmoid operation on the output of the model.
@@ -506,12 +512,10 @@ if __name__ == "__main__":
         opt.update(args)
         args = opt
 
-    df = pd.read_csv(args['traincsvpath']) # Read the traincsvpath file.
-    args['num_samples'] = len(df) # Define the num_samples variable.
-    df_val = pd.read_csv(args['valcsvpath'])
-    args['num_samples_val'] = len(df_val)
-    df_test = pd.read_csv(args['testcsvpath'])
-    args['num_samples_test'] = len(df_test)
+    # Row counts come from one streaming pass per split, cached in a <csv>.manifest.json sidecar.
+    args['num_samples'] = load_manifest(args['traincsvpath'])['rows'] # Define the num_samples variable.
+    args['num_samples_val'] = load_manifest(args['valcsvpath'])['rows']
+    args['num_samples_test'] = load_manifest(args['testcsvpath'])['rows']
     # args['class_freq'] = [3839, 12747, 745, 9243, 4, 163, 13745, 12088]
     args['class_freq'] = [53262, 204846, 10478, 164656, 218, 5246, 230499, 188900]
 
@@ -0,0 +1,496 @@
+# Micro-benchmarks for the GLEE data pipeline.
+# Usage: python benchmark.py label_encode -rows 1000000
+#        python benchmark.py tokenize -csv testset.csv -tokenizer <pretrained dir> -procs 8
+#        python benchmark.py dedup -csv trainset.csv
+#        python benchmark.py packing -csv trainset.csv -tokenizer <pretrained dir>
+#        python benchmark.py windows -csv testset.csv -tokenizer <pretrained dir> -window 128 -stride 96 -max_length 2048
+#        python benchmark.py layer_mix -batch_size 8 -max_length 512
+#        python benchmark.py conv_pool -batch_size 8 -max_length 512
+#        python benchmark.py mha -batch_size 32 -max_length 512
+#        python benchmark.py layer_norm -checkpoint <model dir>/best_macro_model_att_large.pt
+#        python benchmark.py restore -checkpoint <model dir>/best_macro_model_att_large.pt
+#        python benchmark.py checkpoint -checkpoint <model dir>/best_macro_model_att_large.pt -dtype float16
+#        python benchmark.py onnx -batch_sizes 1 4 8 16 -max_length 512
+#        python benchmark.py compile -batch_size 8 -buckets 64 128 256 512
+#        python benchmark.py schedule -runs <fixed run>/training_log.json <scheduled run>/training_log.json
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from util_data import LABEL_VOCAB, encode_multi_hot, pack_labels, dedup_reviews, read_reviews, tokenize_parallel, TokenBudgetBatchSampler, PackedBatchSampler, PackCollator
+
+
+def legacy_one_hot_encode(labels, num_labels=8):
+    # The original row-by-row encoder, kept as the reference implementation.
+    unique_label = np.array(LABEL_VOCAB)
+    one_hot = np.zeros((len(labels), num_labels))
+    for i in range(len(labels)):
+        for j in range(8):
+            try:
+                idx = np.where(unique_label == labels[i][j])[0][0]
+                one_hot[i][idx] = 1
+            except:
+                continue
+    return one_hot
+
+
+def random_label_rows(rows, seed=10):
+    # 1 to 3 labels per review, the remaining label columns empty as in the CSVs.
+    rng = np.random.default_rng(seed)
+    cells = np.full((rows, 8), np.nan, dtype=object)
+    num_labels = rng.integers(1, 4, size=rows)
+    for j in range(3):
+        picked = np.array(LABEL_VOCAB, dtype=object)[rng.integers(0, len(LABEL_VOCAB), size=rows)]
+        cells[num_labels > j, j] = picked[num_labels > j]
+    return cells
+
+
+def bench_label_encode(rows):
+    labels = random_label_rows(rows)
+
+    start = time.perf_counter()
+    fast = encode_multi_hot(labels)
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slow = legacy_one_hot_encode(labels.tolist())
+    slow_time = time.perf_counter() - start
+
+    assert np.array_equal(fast, slow), 'vectorized encoder disagrees with the legacy loop'
+    print('label_encode rows={}: legacy {:.2f}s, vectorized {:.3f}s, speedup {:.0f}x'.format(rows, slow_time, fast_time, slow_time / fast_time))
+
+
+def bench_tokenize(csv_path, tokenizer_path, procs, max_length=512):
+    import pandas as pd
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    texts = pd.read_csv(csv_path, usecols=['description'])['description'].tolist()
+
+    start = time.perf_counter()
+    serial_ids, serial_offsets = tokenize_parallel(texts, tokenizer, max_length, num_proc=1)
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ids, offsets = tokenize_parallel(texts, tokenizer, max_length, num_proc=procs)
+    parallel_time = time.perf_counter() - start
+
+    assert np.array_equal(np.concatenate(ids), np.concatenate(serial_ids)), 'parallel token ids differ from the serial path'
+    assert np.array_equal(np.concatenate([np.diff(o) for o in offsets]), np.concatenate([np.diff(o) for o in serial_offsets]))
+    print('tokenize rows={}: serial {:.2f}s, {} processes {:.2f}s, speedup {:.1f}x'.format(len(texts), serial_time, procs, parallel_time, serial_time / parallel_time))
+
+    # Resident size of the stored ids against padded int64 input_ids plus attention_mask tensors.
+    compact = sum(i.nbytes + o.nbytes for i, o in zip(ids, offsets))
+    padded = len(texts) * max_length * 8 * 2
+    print('storage: {} ids + offsets {:.1f} MB, padded int64 ids + mask {:.1f} MB, {:.0f}x smaller'.format(
+        ids[0].dtype, compact / 2 ** 20, padded / 2 ** 20, padded / compact))
+
+
+def bench_dedup(csv_path):
+    # Share of rows that are duplicates (same normalized text and labels) and thus skip tokenization and the backbone.
+    texts, cells = read_reviews(csv_path)
+    labels = pack_labels(encode_multi_hot(cells))
+
+    start = time.perf_counter()
+    keep, counts, inverse = dedup_reviews(texts, labels)
+    dedup_time = time.perf_counter() - start
+
+    assert np.array_equal(labels[keep][inverse], labels), 'fanned-out labels differ from the CSV rows'
+    print('dedup rows={}: {} unique ({:.1%} duplicates), largest group {}, {:.2f}s; {:.1%} of the forward passes remain'.format(
+        len(texts), len(keep), 1 - len(keep) / len(texts), int(counts.max()), dedup_time, len(keep) / len(texts)))
+
+
+def bench_packing(csv_path, tokenizer_path, max_length=512, batch_size=4):
+    # Share of the positions of every forward pass that hold real tokens: fixed max_length padding,
+    # dynamic padding with the same token budget, and packing batch_size sequences of max_length.
+    import pandas as pd
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    texts = pd.read_csv(csv_path, usecols=['description'])['description'].tolist()
+    ids, offsets = tokenize_parallel(texts, tokenizer, max_length)
+    lengths = np.concatenate([np.diff(o) for o in offsets])
+    useful = lengths.sum()
+
+    dynamic = TokenBudgetBatchSampler(lengths, batch_size * max_length, shuffle=True)
+    dynamic_positions = sum(len(b) * lengths[b].max() for b in dynamic)
+
+    start = time.perf_counter()
+    packed = list(PackedBatchSampler(lengths, max_length, packs_per_batch=batch_size, shuffle=True))
+    pack_time = time.perf_counter() - start
+    collate = PackCollator(0, max_length)
+    rows = np.split(np.concatenate(ids), np.cumsum(lengths)[:-1])
+    label = np.uint8(0)
+    packed_shapes = [collate([(rows[i], label, i) for i in b])[0].shape for b in packed]
+    packed_positions = sum(n * seq_len for n, seq_len in packed_shapes)
+
+    print('packing rows={}: mean length {:.0f}'.format(len(lengths), lengths.mean()))
+    print('useful tokens per position: padded to {} {:.1%}, dynamic padding {:.1%}, packed {:.1%} ({:.1f} reviews per sequence, packed in {:.2f}s)'.format(
+        max_length, useful / (len(lengths) * max_length), useful / dynamic_positions, useful / packed_positions,
+        len(lengths) / sum(n for n, _ in packed_shapes), pack_time))
+
+
+def bench_windows(csv_path, tokenizer_path, window_size, stride, max_length):
+    # Self-attention score FLOPs grow with length^2 per layer; compare one full pass per review
+    # with the sliding-window mode of BertCNNClassifier_att on the real length distribution.
+    import pandas as pd
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+    texts = pd.read_csv(csv_path, usecols=['description'])['description'].tolist()
+    _, offsets = tokenize_parallel(texts, tokenizer, max_length)
+    lengths = np.concatenate([np.diff(o) for o in offsets])
+
+    padded = len(lengths) * 512.0 ** 2
+    full = np.minimum(lengths, 512).astype(np.float64) ** 2
+    body = window_size - 1
+    num_windows = np.where(lengths > window_size, -(-(lengths - 1 - body) // stride) + 1, 1)
+    windowed = np.where(lengths > window_size, num_windows * float(window_size) ** 2, lengths.astype(np.float64) ** 2)
+    truncated = (lengths > 512).mean()
+
+    print('windows rows={}: mean length {:.0f}, {:.1%} longer than 512 tokens'.format(len(lengths), lengths.mean(), truncated))
+    print('attention FLOPs: padded to 512 {:.3g}, one pass per review {:.3g}, windows of {} (stride {}) {:.3g}'.format(
+        padded, full.sum(), window_size, stride, windowed.sum()))
+    print('windows vs padded {:.2f}, windows vs one pass {:.2f}, {:.2f} windows per review'.format(
+        windowed.sum() / padded, windowed.sum() / full.sum(), num_windows.mean()))
+
+
+def bench_schedule(baseline_log, scheduled_log):
+    # Wall-clock time each run needs to first reach the best validation macro-F1 of the fixed-length baseline,
+    # from the training_log.json that main() writes next to the checkpoint.
+    runs = []
+    for path in (baseline_log, scheduled_log):
+        with open(path) as f:
+            runs.append(json.load(f))
+    target = max(runs[0]['macro'])
+
+    reached = []
+    for path, run in zip((baseline_log, scheduled_log), runs):
+        elapsed = np.cumsum(run['epoch_seconds'])
+        hits = np.flatnonzero(np.asarray(run['macro']) >= target)
+        reached.append(elapsed[hits[0]] if len(hits) else None)
+        print('{}: max_length {} -> {}, {} epochs in {:.1f}s, best macro-F1 {:.4f}, reaches {:.4f} {}'.format(
+            path, run['max_length'][0], run['max_length'][-1], len(elapsed), elapsed[-1], max(run['macro']), target,
+            'after {:.1f}s (epoch {})'.format(elapsed[hits[0]], hits[0] + 1) if len(hits) else 'never'))
+    if reached[1] is not None:
+        print('schedule saves {:.1%} of the wall-clock time to the baseline macro-F1'.format(1 - reached[1] / reached[0]))
+
+
+def bench_layer_mix(batch_size, max_length):
+    # Peak memory of one training step (forward and backward) of BertCNNClassifier_att with the hook-accumulated
+    # layer sum, against stacking output_hidden_states=True as before; needs a GPU for the memory figures.
+    import torch
+    from BertCNNClassifier_att import BertCNNClassifier_att
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = BertCNNClassifier_att(num_labels=8, mlp_size=512).to(device)
+    input_ids = torch.randint(1, model.bert.config.vocab_size, (batch_size, max_length), device=device)
+    attention_mask = torch.ones_like(input_ids)
+
+    def stacked(input_ids, attention_mask):
+        hidden_states = model.bert(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True).hidden_states
+        return torch.sum(torch.stack(hidden_states, dim=0) * model.layer_weights.view(-1, 1, 1, 1), dim=0)
+
+    results = {}
+    for name, weighted_hidden in (('stacked', stacked), ('hooks', model.weighted_hidden)):
+        model.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        weighted_sum = weighted_hidden(input_ids, attention_mask)
+        global_feature, local_features = model.pool(weighted_sum)
+        (global_feature.sum() + sum(f.sum() for f in local_features)).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+        results[name] = (weighted_sum.detach(), peak, time.perf_counter() - start)
+        print('{}: peak {:.0f} MiB, {:.3f}s per step'.format(name, peak, results[name][2]))
+        del weighted_sum, global_feature, local_features
+
+    print('max abs difference {:.3g}; one [13, {}, {}, {}] fp32 stack is {:.0f} MiB'.format(
+        (results['stacked'][0] - results['hooks'][0]).abs().max().item(), batch_size, max_length,
+        model.bert.config.hidden_size, 13 * batch_size * max_length * model.bert.config.hidden_size * 4 / 2 ** 20))
+
+
+def bench_conv_pool(batch_size, max_length, repeats=20):
+    # Local head of BertCNNClassifier_att on a batch whose rows are padded from a quarter to all of max_length:
+    # two Conv1d calls and four unmasked poolings as before, against fused_conv_pool with the padding mask; and
+    # fused_conv_pool on a batch padded to max_length whose longest row is half as long, where the padding is cut off.
+    import torch
+    import torch.nn.functional as F
+    from BertCNNClassifier_att import fused_conv_pool
+
+    convs = [torch.nn.Conv1d(768, 256, kernel_size=k, padding=1) for k in (1, 2)]
+    x = torch.randn(batch_size, 768, max_length)
+    lengths = torch.linspace(max_length // 4, max_length, batch_size).long()
+    mask = (torch.arange(max_length)[None, :] < lengths[:, None]).long()
+    short_mask = (torch.arange(max_length)[None, :] < lengths[:, None] // 2).long()
+
+    def separate():
+        pooled = []
+        for conv in convs:
+            local_feature = F.relu(conv(x))
+            pooled.append((F.max_pool1d(local_feature, kernel_size=local_feature.size(2)).squeeze(2),
+                           F.avg_pool1d(local_feature, kernel_size=local_feature.size(2)).squeeze(2)))
+        return pooled
+
+    with torch.no_grad():
+        for name, run in (('separate convs, unmasked pooling', separate), ('fused conv, masked pooling', lambda: fused_conv_pool(x, mask, convs)),
+                          ('fused conv, longest row at half the padding', lambda: fused_conv_pool(x, short_mask, convs))):
+            run()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run()
+            print('{}: {:.2f} ms per batch'.format(name, (time.perf_counter() - start) / repeats * 1000))
+        # Without padding both give the same features.
+        unmasked = max((a - b).abs().max().item() for old, new in zip(separate(), fused_conv_pool(x, None, convs)) for a, b in zip(old, new))
+    print('max abs difference without padding {:.3g}'.format(unmasked))
+
+
+def bench_mha(batch_size, max_length, repeats=200):
+    # attention_global/attention_local of the GLEE head on [batch, 768] inputs: the full scaled dot-product
+    # attention over one key as before, against the closed-form MultiHeadedAttention.single_key path.
+    # Then self-attention over [batch, max_length, 768] sequences: explicit softmax keeping the attention
+    # weights (keep_attn=True) against the packed QKV projection and the fused kernel.
+    import torch
+    from BertCNNClassifier_att import MultiHeadedAttention
+
+    def full_attention(query, key, value):
+        residual, nbatches = query, query.size(0)
+        query, key, value = [x.view(nbatches, -1, attention.h, attention.d_k).transpose(1, 2)
+                             for x in attention.project(query, key, value)]
+        x, _ = attention.attention(query, key, value, dropout=attention.dropout)
+        x = x.transpose(1, 2).contiguous().view(nbatches, -1, attention.h * attention.d_k)
+        return attention.out(x + residual)
+
+    attention = MultiHeadedAttention(8, 768).eval()
+    global_feature, local_features = torch.randn(batch_size, 768), torch.randn(batch_size, 768)
+    with torch.no_grad():
+        for name, run in (('full attention', full_attention), ('single-key closed form', attention)):
+            run(global_feature, local_features, local_features)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run(global_feature, local_features, local_features)
+            print('{}: {:.3f} ms per call'.format(name, (time.perf_counter() - start) / repeats * 1000))
+        difference = (full_attention(global_feature, local_features, local_features) - attention(global_feature, local_features, local_features)).abs().max()
+    print('eval mode max abs difference {:.3g}'.format(difference.item()))
+
+    kept = MultiHeadedAttention(8, 768, keep_attn=True).eval()
+    kept.load_state_dict(attention.state_dict())
+    sequences = torch.randn(batch_size, max_length, 768)
+    with torch.no_grad():
+        for name, run in (('explicit softmax, keep_attn', kept), ('packed QKV, fused attention', attention)):
+            run(sequences, sequences, sequences)
+            start = time.perf_counter()
+            for _ in range(max(repeats // 20, 1)):
+                run(sequences, sequences, sequences)
+            print('{}: {:.2f} ms per call'.format(name, (time.perf_counter() - start) / max(repeats // 20, 1) * 1000))
+        difference = (kept(sequences, sequences, sequences) - attention(sequences, sequences, sequences)).abs().max()
+    print('sequence max abs difference {:.3g}, attention weights kept: {} / {}'.format(
+        difference.item(), tuple(kept.attn.shape), attention.attn))
+
+
+def bench_layer_norm(checkpoint, batch_size, max_length, repeats=200):
+    # FusedLayerNorm on a saved model (a_2/b_2 remapped on load) against the same weights with the reference LayerNorm
+    # of test_layer_norm.py put back into the classifier, a fresh model without -checkpoint; the test checks the equivalence.
+    import torch
+    from BertCNNClassifier_att import BertCNNClassifier_att, FusedLayerNorm
+    from test_layer_norm import LayerNorm
+
+    state_dict = torch.load(checkpoint, map_location='cpu')['state_dict'] if checkpoint else None
+    mlp_size, num_labels = (state_dict['classifier.0.weight'].size(0), state_dict['classifier.4.weight'].size(0)) if state_dict else (512, 8)
+    model = BertCNNClassifier_att(num_labels=num_labels, mlp_size=mlp_size).eval()
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    fused = model.classifier[1]
+    reference = LayerNorm(mlp_size, eps=fused.eps)
+    reference.a_2.data, reference.b_2.data = fused.weight.data, fused.bias.data
+    standard = FusedLayerNorm(mlp_size, eps=fused.eps, standard=True)
+    standard.load_state_dict(fused.state_dict())
+
+    input_ids = torch.randint(1, model.bert.config.vocab_size, (batch_size, max_length))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[batch_size // 2:, max_length // 2:] = 0
+    logits = {}
+    with torch.no_grad():
+        for name, norm in (('reference', reference), ('fused', fused), ('standard', standard)):
+            model.classifier[1] = norm
+            logits[name] = model(input_ids, attention_mask)
+
+            x = torch.randn(4096, mlp_size)
+            norm(x)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                norm(x)
+            print('{}: {:.3f} ms per [4096, {}] call'.format(name, (time.perf_counter() - start) / repeats * 1000, mlp_size))
+    model.classifier[1] = fused
+
+    difference = (logits['reference'] - logits['fused']).abs().max().item()
+    print('max abs logit difference: fused {:.3g}, standard semantics {:.3g}'.format(
+        difference, (logits['reference'] - logits['standard']).abs().max().item()))
+
+
+def bench_restore(checkpoint):
+    # Startup of load_model for -mode test: backbone from the pretrained weights and then overwritten by the
+    # checkpoint as before, against building it from its config only and loading the checkpoint once.
+    import torch
+    from BertCNNClassifier_att import BertCNNClassifier_att
+
+    state_dict = torch.load(checkpoint, map_location='cpu')['state_dict']
+    mlp_size, num_labels = state_dict['classifier.0.weight'].size(0), state_dict['classifier.4.weight'].size(0)
+    del state_dict
+
+    restored = {}
+    for name, pretrained in (('from_pretrained + checkpoint', True), ('from_config + checkpoint', False)):
+        start = time.perf_counter()
+        model = BertCNNClassifier_att(num_labels=num_labels, mlp_size=mlp_size, pretrained=pretrained)
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu')['state_dict'])
+        print('{}: {:.2f}s'.format(name, time.perf_counter() - start))
+        restored[name] = model.state_dict()
+    assert all(torch.equal(a, b) for a, b in zip(*(state.values() for state in restored.values()))), 'restored weights differ'
+
+
+def bench_checkpoint(checkpoint, dtype, batch_size, max_length):
+    # Converts a torch.save checkpoint into its .safetensors sibling (weights stored as dtype), then times restoring
+    # a config-only model from each file and compares the logits of the two restored models.
+    import os
+    import torch
+    from BertCNNClassifier_att import BertCNNClassifier_att
+    from util_checkpoint import checkpoint_path, save_checkpoint, load_checkpoint, load_into
+
+    state_dict, metadata = load_checkpoint(checkpoint)
+    mlp_size, num_labels = state_dict['classifier.0.weight'].size(0), state_dict['classifier.4.weight'].size(0)
+    converted = checkpoint_path(checkpoint, 'safetensors')
+    save_checkpoint(converted, state_dict, dict(metadata, num_labels=num_labels, mlp_size=mlp_size), dtype=dtype)
+    del state_dict
+
+    input_ids = torch.randint(1, 500, (batch_size, max_length))
+    logits = []
+    for path in (checkpoint, converted):
+        model = BertCNNClassifier_att(num_labels=num_labels, mlp_size=mlp_size, pretrained=False).eval()
+        start = time.perf_counter()
+        load_into(model, path)
+        elapsed = time.perf_counter() - start
+        print('{}: {:.0f} MiB on disk, loaded in {:.3f}s'.format(os.path.basename(path), os.path.getsize(path) / 2 ** 20, elapsed))
+        with torch.no_grad():
+            logits.append(model(input_ids, torch.ones_like(input_ids)))
+    print('header: {}'.format(load_checkpoint(converted)[1]))
+    print('max abs logit difference {:.3g}'.format((logits[0] - logits[1]).abs().max().item()))
+
+
+def bench_onnx(batch_sizes, max_length, repeats=5, tolerance=1e-3):
+    # Parity and CPU throughput of the ONNX Runtime backend against PyTorch, for BertCNNClassifier and
+    # BertCNNClassifier_att exported once each and run at every batch size, with half of every batch padded.
+    import os
+    import tempfile
+    import torch
+    from BertCNNClassifier import BertCNNClassifier
+    from BertCNNClassifier_att import BertCNNClassifier_att
+    from onnx_backend import export_onnx, OnnxClassifier
+
+    for model_class in (BertCNNClassifier, BertCNNClassifier_att):
+        model = model_class(num_labels=8, mlp_size=512).eval()
+        with tempfile.TemporaryDirectory() as tmp:
+            session = OnnxClassifier(export_onnx(model, os.path.join(tmp, 'model.onnx')))
+            for batch_size in batch_sizes:
+                input_ids = torch.randint(1, model.bert.config.vocab_size, (batch_size, max_length))
+                attention_mask = torch.ones_like(input_ids)
+                attention_mask[batch_size // 2:, max_length // 2:] = 0
+                logits, throughput = {}, {}
+                for backend, run in (('torch', model), ('onnx', session)):
+                    with torch.no_grad():
+                        logits[backend] = run(input_ids, attention_mask)
+                        start = time.perf_counter()
+                        for _ in range(repeats):
+                            run(input_ids, attention_mask)
+                    throughput[backend] = batch_size * repeats / (time.perf_counter() - start)
+                difference = (logits['torch'] - logits['onnx']).abs().max().item()
+                print('{} batch {}: PyTorch {:.1f} reviews/s, ONNX Runtime {:.1f} reviews/s ({:.2f}x), max abs logit difference {:.3g}'.format(
+                    model_class.__name__, batch_size, throughput['torch'], throughput['onnx'], throughput['onnx'] / throughput['torch'], difference))
+                assert difference <= tolerance, 'ONNX Runtime logits differ from PyTorch by more than {}'.format(tolerance)
+
+
+def bench_compile(batch_size, buckets, backend, batches=20, tolerance=1e-4):
+    # Eager BertCNNClassifier_att against CompiledClassifier on batches of random lengths up to the largest bucket,
+    # as dynamic padding produces them; the one-off compile time of the buckets is reported separately.
+    import numpy as np
+    import torch
+    from BertCNNClassifier_att import BertCNNClassifier_att
+    from compiled_backend import CompiledClassifier
+
+    model = BertCNNClassifier_att(num_labels=8, mlp_size=512).eval()
+    compiled = CompiledClassifier(model, buckets=buckets, backend=backend)
+    print('{}: compiled {} buckets in {:.1f}s'.format(compiled.backend, len(compiled.buckets), compiled.compile_seconds))
+
+    rng = np.random.RandomState(10)
+    inputs = []
+    for length in rng.randint(8, max(buckets) + 1, size=batches):
+        input_ids = torch.randint(1, model.bert.config.vocab_size, (batch_size, int(length)))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[batch_size // 2:, length // 2:] = 0
+        inputs.append((input_ids, attention_mask))
+
+    logits, seconds = {}, {}
+    with torch.no_grad():
+        for name, run in (('eager', model), ('compiled', compiled)):
+            start = time.perf_counter()
+            logits[name] = [run(input_ids, attention_mask) for input_ids, attention_mask in inputs]
+            seconds[name] = time.perf_counter() - start
+    difference = max((a - b).abs().max().item() for a, b in zip(logits['eager'], logits['compiled']))
+    print('eager {:.2f}s, compiled {:.2f}s ({:.2f}x) for {} batches of {}; max abs logit difference {:.3g}'.format(
+        seconds['eager'], seconds['compiled'], seconds['eager'] / seconds['compiled'], batches, batch_size, difference))
+    assert difference <= tolerance, 'compiled logits differ from eager by more than {}'.format(tolerance)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', help="benchmark to run", choices=['label_encode', 'tokenize', 'dedup', 'packing', 'windows', 'layer_mix', 'conv_pool', 'mha', 'layer_norm', 'restore', 'checkpoint', 'onnx', 'compile', 'schedule'])
+    parser.add_argument('-rows', help="number of synthetic rows", type=int, required=False, default=1000000)
+    parser.add_argument('-csv', help="CSV with a description column", type=str, required=False)
+    parser.add_argument('-tokenizer', help="pretrained tokenizer directory", type=str, required=False)
+    parser.add_argument('-procs', help="tokenizer processes", type=int, required=False, default=8)
+    parser.add_argument('-window', help="window size in tokens", type=int, required=False, default=128)
+    parser.add_argument('-stride', help="tokens between window starts", type=int, required=False, default=96)
+    parser.add_argument('-max_length', help="tokenizer truncation length", type=int, required=False, default=2048)
+    parser.add_argument('-batch_size', help="reviews per batch", type=int, required=False, default=8)
+    parser.add_argument('-checkpoint', help="saved best_macro_model_att_large.pt", type=str, required=False)
+    parser.add_argument('-dtype', help="dtype of the converted safetensors weights", type=str, required=False, default='float32')
+    parser.add_argument('-batch_sizes', help="batch sizes to compare", type=int, nargs='+', required=False, default=[1, 4, 8, 16])
+    parser.add_argument('-buckets', help="sequence-length buckets of the compiled graphs", type=int, nargs='+', required=False, default=[64, 128, 256, 512])
+    parser.add_argument('-compile_backend', help="auto, compile or trace", type=str, required=False, default='auto')
+    parser.add_argument('-runs', help="training_log.json of a fixed-length run and of a scheduled run", nargs=2, required=False)
+    args = parser.parse_args()
+
+    if args.bench == 'label_encode':
+        bench_label_encode(args.rows)
+    elif args.bench == 'tokenize':
+        bench_tokenize(args.csv, args.tokenizer, args.procs)
+    elif args.bench == 'dedup':
+        bench_dedup(args.csv)
+    elif args.bench == 'packing':
+        bench_packing(args.csv, args.tokenizer)
+    elif args.bench == 'windows':
+        bench_windows(args.csv, args.tokenizer, args.window, args.stride, args.max_length)
+    elif args.bench == 'layer_mix':
+        bench_layer_mix(args.batch_size, args.max_length)
+    elif args.bench == 'conv_pool':
+        bench_conv_pool(args.batch_size, args.max_length)
+    elif args.bench == 'mha':
+        bench_mha(args.batch_size, args.max_length)
+    elif args.bench == 'layer_norm':
+        bench_layer_norm(args.checkpoint, args.batch_size, min(args.max_length, 512))
+    elif args.bench == 'restore':
+        bench_restore(args.checkpoint)
+    elif args.bench == 'checkpoint':
+        bench_checkpoint(args.checkpoint, args.dtype, args.batch_size, min(args.max_length, 512))
+    elif args.bench == 'onnx':
+        bench_onnx(args.batch_sizes, min(args.max_length, 512))
+    elif args.bench == 'compile':
+        bench_compile(args.batch_size, args.buckets, args.compile_backend)
+    elif args.bench == 'schedule':
+        bench_schedule(*args.runs)
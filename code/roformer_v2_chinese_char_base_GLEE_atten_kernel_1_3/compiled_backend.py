@@ -0,0 +1,73 @@
+# Compiled inference for BertCNNClassifier_att with precompiled sequence-length buckets.
+#
+# In eager mode every small op of the head (layer mix, permute, conv taps, pooling, cat, the two attention modules,
+# mean and MLP) pays Python dispatch. CompiledClassifier builds one graph per sequence-length bucket at startup, with
+# torch.compile where it exists (torch 2.x) and TorchScript traces otherwise, and pads every batch to its bucket, so
+# batches of any length up to the largest bucket reuse a graph and never trigger a recompile. The padding does not
+# change the logits: the backbone attention and the masked conv pooling of BertCNNClassifier_att both ignore it.
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+SEQUENCE_BUCKETS = (64, 128, 256, 512)
+
+
+def mark_batch_dynamic(tensor):
+    # The batch axis stays symbolic in the compiled graphs, so any batch size of two or more reuses them.
+    mark = getattr(torch._dynamo, 'maybe_mark_dynamic', None) or torch._dynamo.mark_dynamic
+    mark(tensor, 0)
+
+
+class CompiledClassifier:
+    """BertCNNClassifier_att with one compiled graph per sequence-length bucket, called like the model.
+
+    Batches longer than the largest bucket run eager, and so do single-review
+    batches, which torch.compile would otherwise specialise and recompile for.
+    """
+
+    def __init__(self, model, buckets=SEQUENCE_BUCKETS, backend='auto', pad_token_id=0):
+        if model.packing or model.window_size:
+            raise ValueError('packing and sliding windows cannot be compiled per bucket, their control flow depends on the input')
+        if backend == 'auto':
+            backend = 'compile' if hasattr(torch, 'compile') else 'trace'
+        self.model = model.eval()
+        self.backend = backend
+        self.buckets = sorted(buckets)
+        self.pad_token_id = pad_token_id
+        self.checkpoint_metadata = getattr(model, 'checkpoint_metadata', {})
+
+        device = next(model.parameters()).device
+        compiled = torch.compile(model, dynamic=False) if backend == 'compile' else None
+        self.graphs = {}
+        start = time.perf_counter()
+        with torch.no_grad():
+            for length in self.buckets:
+                input_ids = torch.ones(2, length, dtype=torch.long, device=device)
+                attention_mask = torch.ones_like(input_ids)
+                attention_mask[1, length // 2:] = 0  # A padded row, so the masking ops are part of the graph.
+                if backend == 'compile':
+                    mark_batch_dynamic(input_ids)
+                    mark_batch_dynamic(attention_mask)
+                    compiled(input_ids, attention_mask)  # Compiles the graph of this bucket now rather than on the first batch.
+                    self.graphs[length] = compiled
+                else:
+                    self.graphs[length] = torch.jit.trace(model, (input_ids, attention_mask), check_trace=False)
+        self.compile_seconds = time.perf_counter() - start
+
+    def to(self, device):
+        return self  # The graphs are built on the device of the model.
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask=None):
+        batch_size, length = input_ids.shape
+        bucket = next((bucket for bucket in self.buckets if bucket >= length), None)
+        if bucket is None or batch_size < 2:
+            return self.model(input_ids, attention_mask)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        padding = bucket - length
+        return self.graphs[bucket](F.pad(input_ids, (0, padding), value=self.pad_token_id), F.pad(attention_mask, (0, padding)))
@@ -0,0 +1,52 @@
+# Equivalence of the single-key fast path of MultiHeadedAttention with the full projection / softmax path.
+# Run with: python -m pytest test_attention.py
+
+import torch
+
+from BertCNNClassifier_att import MultiHeadedAttention
+
+TOLERANCE = 1e-5
+
+
+def eval_attention():
+    torch.manual_seed(0)
+    return MultiHeadedAttention(8, 768).eval()
+
+
+def full_attention(mha, query, key, value):
+    # The general path of forward, taken for any number of keys: all three projections, softmax, output projection.
+    residual, nbatches = query, query.size(0)
+    query, key, value = [x.view(nbatches, -1, mha.h, mha.d_k).transpose(1, 2) for x in mha.project(query, key, value)]
+    x, _ = mha.attention(query, key, value)
+    x = x.transpose(1, 2).contiguous().view(nbatches, -1, mha.h * mha.d_k)
+    return mha.out(x + residual)
+
+
+def assert_close(actual, expected):
+    assert actual.shape == expected.shape
+    difference = (actual - expected).abs().max().item()
+    assert difference <= TOLERANCE, 'single_key differs from the full attention by {}'.format(difference)
+
+
+@torch.no_grad()
+def test_two_dimensional_inputs_match_full_attention():
+    mha = eval_attention()
+    query, key, value = torch.randn(4, 768), torch.randn(4, 768), torch.randn(4, 768)
+    assert_close(mha(query, key, value), full_attention(mha, query, key, value))  # [4, 4, 768], as broadcast before.
+    assert_close(mha(query, query, query), full_attention(mha, query, query, query))  # Self-attention of the GLEE head.
+
+
+@torch.no_grad()
+def test_single_key_sequences_match_full_attention():
+    mha = eval_attention()
+    query, value = torch.randn(4, 1, 768), torch.randn(4, 1, 768)
+    assert_close(mha(query, value, value), full_attention(mha, query, value, value))  # key.size(-2) == 1.
+
+
+@torch.no_grad()
+def test_output_bias_is_added_once():
+    mha = eval_attention()
+    mha.qkv.bias.zero_()
+    zeros = torch.zeros(4, 1, 768)
+    # Zero inputs leave only the output bias: self.out(x) carries it, F.linear(residual, self.out.weight) does not.
+    assert_close(mha.single_key(zeros, zeros), mha.out.bias.expand(4, 1, 768))
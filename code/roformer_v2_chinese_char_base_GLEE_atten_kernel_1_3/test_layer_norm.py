@@ -0,0 +1,109 @@
+# Equivalence of FusedLayerNorm with the reference LayerNorm of the GLEE classifier head, on the module and on the
+# logits of a saved classifier.
+# Run with: python -m pytest test_layer_norm.py
+
+import math
+
+import torch
+import torch.nn as nn
+from transformers import BertConfig
+
+import BertCNNClassifier_att
+from BertCNNClassifier_att import FusedLayerNorm
+from util_checkpoint import save_checkpoint, load_into
+
+TOLERANCE = 1e-4
+
+
+class LayerNorm(nn.Module):
+    # The classifier LayerNorm that FusedLayerNorm replaced; checkpoints saved before hold its a_2 / b_2.
+
+    def __init__(self, features, eps=1e-6):
+        super(LayerNorm, self).__init__()
+        self.a_2 = nn.Parameter(torch.ones(features))
+        self.b_2 = nn.Parameter(torch.zeros(features))
+        self.eps = eps
+
+    def forward(self, x):
+        mean = x.mean(-1, keepdim=True)
+        std = x.std(-1, keepdim=True)
+        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+
+
+def reference_and_fused(features=200, eps=1e-6):
+    torch.manual_seed(0)
+    reference = LayerNorm(features, eps=eps)
+    reference.a_2.data.normal_(1.0, 0.1)
+    reference.b_2.data.normal_(0.0, 0.1)
+    fused = FusedLayerNorm(features, eps=eps)
+    fused.load_state_dict(reference.state_dict())  # a_2 / b_2 remapped to weight / bias.
+    return reference, fused
+
+
+def test_unbiased_semantics_match_reference():
+    reference, fused = reference_and_fused()
+    for scale in (1.0, 1e-2, 1e-5):  # Small input std is where eps placement matters.
+        x = torch.randn(64, 200) * scale + 3.0 * scale
+        difference = (reference(x) - fused(x)).abs().max().item()
+        assert difference <= TOLERANCE, 'std {}: FusedLayerNorm differs from LayerNorm by {}'.format(scale, difference)
+
+
+def test_checkpoint_parameters_are_remapped():
+    reference, fused = reference_and_fused()
+    assert torch.equal(fused.weight, reference.a_2)
+    assert torch.equal(fused.bias, reference.b_2)
+
+
+def test_standard_semantics_match_nn_layer_norm():
+    _, fused = reference_and_fused()
+    standard = FusedLayerNorm(200, eps=fused.eps, standard=True)
+    standard.load_state_dict(fused.state_dict())
+    native = nn.LayerNorm(200, eps=fused.eps)
+    native.load_state_dict(fused.state_dict())
+    x = torch.randn(64, 200)
+    assert (standard(x) - native(x)).abs().max().item() <= TOLERANCE
+
+
+class TinyConfig:
+    # A randomly initialised 768-wide, 12-layer BERT stands in for the pretrained backbone (pretrained=False).
+    @staticmethod
+    def from_pretrained(*args, **kwargs):
+        return BertConfig(vocab_size=100, hidden_size=768, num_hidden_layers=12, num_attention_heads=12, intermediate_size=64)
+
+
+def classifier(standard_layer_norm=False):
+    return BertCNNClassifier_att.BertCNNClassifier_att(num_labels=8, mlp_size=200, standard_layer_norm=standard_layer_norm, pretrained=False).eval()
+
+
+@torch.no_grad()
+def test_saved_model_logits_match_reference(monkeypatch, tmp_path):
+    monkeypatch.setattr(BertCNNClassifier_att, 'AutoConfig', TinyConfig)
+    torch.manual_seed(0)
+    saved = classifier()
+    saved.bert.init_weights()  # pretrained=False leaves the backbone uninitialised for the checkpoint to fill.
+    saved.classifier[1] = LayerNorm(200)  # A model trained before FusedLayerNorm: classifier.1.a_2 / classifier.1.b_2.
+    saved.classifier[1].a_2.data.normal_(1.0, 0.1)
+    saved.classifier[1].b_2.data.normal_(0.0, 0.1)
+    torch.save({'epoch': 1, 'state_dict': saved.state_dict()}, str(tmp_path / 'model.pt'))
+    save_checkpoint(str(tmp_path / 'model.safetensors'), saved.state_dict(), {'epoch': 1})
+
+    input_ids = torch.randint(1, 100, (4, 32))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[2:, 16:] = 0
+    expected = saved(input_ids, attention_mask)
+    for name in ('model.pt', 'model.safetensors'):
+        exact, standard = classifier(), classifier(standard_layer_norm=True)
+        load_into(exact, str(tmp_path / name))
+        load_into(standard, str(tmp_path / name))
+        normalized = []
+        exact.classifier[1].register_forward_hook(lambda module, inputs, output: normalized.append(output - module.bias))
+        logits = exact(input_ids, attention_mask)
+        difference = (logits - expected).abs().max().item()
+        assert difference <= TOLERANCE, '{}: logits differ from the reference LayerNorm by {}'.format(name, difference)
+
+        # Documented bound of standard=True: each normalized activation grows by at most sqrt(n / (n - 1)) - 1, and
+        # ReLU / eval-mode dropout do not enlarge the change, so no logit moves by more than |W| @ that change.
+        growth = math.sqrt(200 / 199) - 1
+        bound = growth * normalized[0].abs() @ standard.classifier[4].weight.abs().t()
+        deviation = (standard(input_ids, attention_mask) - logits).abs()
+        assert (deviation <= bound + TOLERANCE).all(), '{}: standard_layer_norm moves logits by {}'.format(name, deviation.max().item())
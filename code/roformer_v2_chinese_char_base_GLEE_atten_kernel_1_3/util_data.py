@@ -0,0 +1,762 @@
+# Data pipeline helpers for the GLEE training and testing scripts.
+
+import bisect
+import collections
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+
+LABEL_COLUMNS = ['label1', 'label2', 'label3', 'label4', 'label5', 'label6', 'label7', 'label8']
+LABEL_VOCAB = ['旅游交通', '游览', '旅游安全', '卫生', '邮电', '旅游购物', '经营管理', '资源和环境保护']
+
+
+REVIEW_COLUMNS = ['description'] + LABEL_COLUMNS
+
+
+def table_format(path):
+    """'parquet', 'arrow' (Arrow IPC / Feather) or 'csv', from the file extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+    if ext in ('.arrow', '.feather', '.ipc'):
+        return 'arrow'
+    return 'csv'
+
+
+def _arrow_reviews(batch):
+    # Strings go from the Arrow buffers to a plain list for the tokenizer, without an intermediate DataFrame.
+    texts = batch.column('description').to_pylist()
+    labels = np.asarray(batch.select(LABEL_COLUMNS).to_pandas().values, dtype=object)
+    return texts, labels
+
+
+def iter_reviews(path, chunk_size=None, source=None):
+    """Yield (description list, [n, 8] label cell array) chunks, reading only the description and label columns.
+
+    CSV, Parquet and Arrow IPC/Feather files are supported. chunk_size=None
+    reads the whole file as one chunk. source optionally replaces path as the
+    file object a CSV is parsed from.
+    """
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        if chunk_size is None:
+            yield _arrow_reviews(pq.read_table(path, columns=REVIEW_COLUMNS))
+            return
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=REVIEW_COLUMNS):
+            yield _arrow_reviews(batch)
+    elif fmt == 'arrow':
+        import pyarrow as pa
+        with pa.memory_map(path) as f:
+            try:
+                reader = pa.ipc.open_file(f)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            except pa.ArrowInvalid: # Arrow IPC stream format rather than file format.
+                f.seek(0)
+                batches = pa.ipc.open_stream(f)
+            table = pa.Table.from_batches(list(batches)).select(REVIEW_COLUMNS) # Memory-mapped, no copy.
+            for batch in ([table] if chunk_size is None else table.to_batches(max_chunksize=chunk_size)):
+                yield _arrow_reviews(batch)
+    else:
+        reader = pd.read_csv(source or path, index_col=False, usecols=REVIEW_COLUMNS, chunksize=chunk_size)
+        for chunk in ([reader] if chunk_size is None else reader):
+            yield chunk['description'].tolist(), chunk[LABEL_COLUMNS].values
+
+
+def read_reviews(path):
+    """Read the description texts and label cells of a whole split."""
+    texts, labels = next(iter_reviews(path))
+    return texts, labels
+
+
+def encode_multi_hot(labels, label_vocab=LABEL_VOCAB):
+    """Map the label1..label8 cells of every row to a [N, len(label_vocab)] 0/1 matrix.
+
+    All cells are factorized in one pass and only the few distinct names are
+    looked up in the vocabulary; empty cells and names outside the vocabulary
+    get index -1 and are skipped.
+    """
+    labels = np.asarray(labels, dtype=object)
+    cell_codes, names = pd.factorize(labels.ravel())
+    name_codes = np.append(pd.Index(label_vocab).get_indexer(names), -1) # Code -1 (empty cell) indexes the trailing -1.
+    codes = name_codes[cell_codes].reshape(labels.shape)
+    one_hot = np.zeros((len(labels), len(label_vocab)), dtype=np.float32)
+    rows, cols = np.nonzero(codes >= 0)
+    one_hot[rows, codes[rows, cols]] = 1
+    return one_hot
+
+
+def label_bits_dtype(num_labels):
+    """Integer dtype of a label bitmask: uint8 for up to 8 labels, wider signed types (torch has no uint16/32) beyond."""
+    for dtype in (np.uint8, np.int16, np.int32):
+        if num_labels <= np.iinfo(dtype).bits - (dtype != np.uint8):
+            return dtype
+    return np.int64
+
+
+def pack_labels(one_hot):
+    """[N, num_labels] 0/1 matrix -> [N] bitmask, bit j set when label j is present."""
+    one_hot = np.asarray(one_hot) > 0
+    weights = np.int64(1) << np.arange(one_hot.shape[1], dtype=np.int64)
+    return (one_hot @ weights).astype(label_bits_dtype(one_hot.shape[1]))
+
+
+def unpack_labels(bits, num_labels):
+    """[N] bitmask -> [N, num_labels] 0/1 uint8 matrix."""
+    return ((np.asarray(bits, dtype=np.int64)[:, None] >> np.arange(num_labels)) & 1).astype(np.uint8)
+
+
+def pack_label_tensor(labels):
+    """Torch version of pack_labels for a [B, num_labels] boolean or 0/1 tensor, on its own device."""
+    weights = torch.ones(labels.size(1), dtype=torch.long, device=labels.device) << torch.arange(labels.size(1), device=labels.device)
+    return ((labels > 0).long() * weights).sum(dim=1).to(getattr(torch, np.dtype(label_bits_dtype(labels.size(1))).name))
+
+
+def unpack_label_tensor(bits, num_labels):
+    """[B] bitmask tensor -> [B, num_labels] float 0/1 tensor on the same device, for the loss."""
+    return ((bits.long()[:, None] >> torch.arange(num_labels, device=bits.device)) & 1).float()
+
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+def popcount(bits):
+    """Number of set bits in every element of an integer array."""
+    bits = np.ascontiguousarray(bits)
+    return _POPCOUNT8[bits.view(np.uint8)].reshape(len(bits), -1).sum(axis=1)
+
+
+def bit_metrics(true_bits, pred_bits, num_labels):
+    """Micro F1, macro F1, subset accuracy, weighted F1, weighted Jaccard and Hamming loss of bitmask labels.
+
+    Same values as sklearn's f1_score / accuracy_score / jaccard_score /
+    hamming_loss on the unpacked boolean matrices (zero_division=0), computed
+    from popcounts of AND / AND-NOT / XOR of the packed bits.
+    """
+    true_bits = np.asarray(true_bits).astype(np.int64)
+    pred_bits = np.asarray(pred_bits).astype(np.int64)
+    tp_bits, fp_bits, fn_bits = true_bits & pred_bits, ~true_bits & pred_bits, true_bits & ~pred_bits
+
+    def ratio(num, den):
+        return np.divide(num, den, out=np.zeros(np.shape(num), dtype=np.float64), where=np.asarray(den) > 0)
+
+    tp, fp, fn = (popcount(x).sum() for x in (tp_bits, fp_bits, fn_bits))
+    micro = float(ratio(2 * tp, 2 * tp + fp + fn))
+
+    shifts = np.arange(num_labels)
+    tp_label, fp_label, fn_label = (((x[:, None] >> shifts) & 1).sum(axis=0) for x in (tp_bits, fp_bits, fn_bits))
+    f1_label = ratio(2 * tp_label, 2 * tp_label + fp_label + fn_label)
+    jaccard_label = ratio(tp_label, tp_label + fp_label + fn_label)
+    support = tp_label + fn_label
+
+    macro = float(f1_label.mean())
+    weighted_f1 = float(ratio((f1_label * support).sum(), support.sum()))
+    jaccard = float(ratio((jaccard_label * support).sum(), support.sum()))
+    accuracy = float((true_bits == pred_bits).mean())
+    hl = float(popcount(true_bits ^ pred_bits).sum() / (len(true_bits) * num_labels))
+    return micro, macro, accuracy, weighted_f1, jaccard, hl
+
+
+def normalize_text(text):
+    """Review text with leading/trailing whitespace stripped and inner whitespace runs collapsed to one space."""
+    return ' '.join(str(text).split())
+
+
+def dedup_reviews(texts, labels):
+    """Group exact duplicates by normalized text and label bitmask.
+
+    Returns (keep, counts, inverse): the index of the first row of every
+    group in CSV order, the number of rows in each group and, for every row,
+    the group it belongs to. Rows with the same text but different labels
+    stay apart, so fanning predictions out through inverse reproduces the
+    labels of every row.
+    """
+    label_bits = np.asarray(labels).astype(np.int64)
+    text_codes, _ = pd.factorize(pd.Series([normalize_text(t) for t in texts], dtype=object))
+    keys = text_codes.astype(np.int64) * (int(label_bits.max(initial=0)) + 1) + label_bits
+    _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first, kind='stable') # Groups in order of their first row.
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], counts[order].astype(np.float32), rank[inverse.reshape(-1)]
+
+
+class TokenizedDataset(Dataset):
+    """Un-padded token ids stored as shards of one flat id array plus per-row offsets.
+
+    Ids are kept in their compact storage dtype (uint16 for every vocabulary
+    used here) and only widened to int64, together with the attention mask,
+    per batch in PadCollator; a row costs 2 bytes per token plus its offset.
+
+    The shards are plain numpy arrays, so they can equally be in-memory or
+    memory-mapped from the token cache. Labels are one bitmask per row (see
+    pack_labels). Every item is returned as (token ids, label bitmask, row
+    index) so that batches built out of CSV order can be put back in order
+    afterwards.
+
+    A deduplicated split holds one row per group of duplicates, with counts
+    (rows per group) and inverse (group of every CSV row); fan_out maps
+    per-group results back to every CSV row.
+    """
+
+    def __init__(self, ids, offsets, labels, counts=None, inverse=None):
+        self.ids = list(ids) # One flat id array per shard.
+        self.offsets = list(offsets) # Row offsets into the shard, len(rows) + 1 each.
+        self.row_starts = np.cumsum([0] + [len(o) - 1 for o in self.offsets])
+        self.full_lengths = np.concatenate([np.diff(o) for o in self.offsets]) if self.offsets else np.zeros(0, dtype=np.int64)
+        self.lengths = self.full_lengths
+        self.max_length = None
+        self.labels = labels
+        self.counts = counts
+        self.inverse = inverse
+
+    def set_max_length(self, max_length):
+        """Re-slice rows to at most max_length tokens on access, keeping their final [SEP] as tokenizer truncation does."""
+        self.max_length = max_length
+        self.lengths = self.full_lengths if max_length is None else np.minimum(self.full_lengths, max_length)
+
+    def fan_out(self, rows):
+        """Rows in dataset order -> rows in CSV order, repeating each group's row for all of its duplicates."""
+        return rows if self.inverse is None else np.asarray(rows)[self.inverse]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        shard = np.searchsorted(self.row_starts, idx, side='right') - 1
+        row = idx - self.row_starts[shard]
+        offsets = self.offsets[shard]
+        ids = self.ids[shard][offsets[row]:offsets[row + 1]]
+        if self.max_length is not None and len(ids) > self.max_length:
+            ids = np.concatenate((ids[:self.max_length - 1], ids[-1:]))
+        return ids, self.labels[idx], idx
+
+
+def token_dtype(vocab_size):
+    """Smallest unsigned dtype that holds every token id: uint16 for vocabularies up to 65536 ids."""
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def encode_shard(input_ids, dtype=np.int32):
+    """Flatten a list of token id lists into (flat ids, row offsets)."""
+    lengths = np.fromiter((len(x) for x in input_ids), dtype=np.int64, count=len(input_ids))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=dtype, count=int(offsets[-1]))
+    return ids, offsets
+
+
+_shard_tokenizer = None
+_shard_max_length = None
+_shard_dtype = None
+
+
+def _set_shard_tokenizer(tokenizer, max_length):
+    global _shard_tokenizer, _shard_max_length, _shard_dtype
+    _shard_tokenizer = tokenizer
+    _shard_max_length = max_length
+    _shard_dtype = token_dtype(len(tokenizer))
+
+
+def _init_tokenize_worker(tokenizer, max_length):
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false' # Parallelism comes from the pool, not from the Rust thread pool.
+    _set_shard_tokenizer(tokenizer, max_length)
+
+
+def _tokenize_shard(texts):
+    input_ids = _shard_tokenizer(texts, padding=False, truncation=True, max_length=_shard_max_length)['input_ids']
+    return encode_shard(input_ids, dtype=_shard_dtype)
+
+
+def tokenize_parallel(texts, tokenizer, max_length, num_proc=1, shard_rows=20000):
+    """Tokenize texts in shards of shard_rows across num_proc processes.
+
+    Returns the per-shard (flat ids, offsets) lists in input order, ready for
+    TokenizedDataset; the rows are identical to tokenizing everything at once.
+    Ids are stored as uint16 whenever the vocabulary fits in 16 bits.
+    """
+    starts = range(0, len(texts), shard_rows)
+    if num_proc <= 1 or len(texts) <= shard_rows:
+        _set_shard_tokenizer(tokenizer, max_length) # In this process, which keeps the tokenizer's own batch parallelism.
+        shards = [_tokenize_shard(texts[start:start + shard_rows]) for start in starts]
+    else:
+        with multiprocessing.Pool(num_proc, initializer=_init_tokenize_worker, initargs=(tokenizer, max_length)) as pool:
+            shards = pool.map(_tokenize_shard, [texts[start:start + shard_rows] for start in starts], chunksize=1)
+    return [ids for ids, _ in shards], [offsets for _, offsets in shards]
+
+
+class StreamingReviewDataset(IterableDataset):
+    """Stream a split in chunks, tokenizing each chunk only when it is reached.
+
+    Rows are shuffled inside a buffer of at most shuffle_buffer items, so peak
+    memory depends on chunk_size and shuffle_buffer rather than on the corpus
+    size. With several DataLoader workers each worker reads and parses every
+    chunk but only tokenizes its own share (chunk k goes to worker k %
+    num_workers): tokenization is split across workers, while file reading
+    and CSV parsing are repeated by each of them. Quoted reviews may span
+    lines, so a CSV cannot be cut into per-worker byte ranges safely.
+
+    Args:
+        path (str): CSV, Parquet or Arrow file with a description column and label1..label8.
+        tokenizer: Hugging Face tokenizer.
+        max_length (int): Truncation length.
+        encode_labels (callable): Maps an array of label rows to one label bitmask per row.
+        num_rows (int): Number of rows in the file, reported by __len__.
+        chunk_size (int): Rows read and tokenized at a time.
+        shuffle_buffer (int): Size of the shuffle buffer, 0 keeps file order.
+    """
+
+    def __init__(self, path, tokenizer, max_length, encode_labels, num_rows=None, chunk_size=10000, shuffle_buffer=50000):
+        super(StreamingReviewDataset, self).__init__()
+        self.path = path
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.encode_labels = encode_labels
+        self.dtype = token_dtype(len(tokenizer))
+        self.num_rows = num_rows
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+
+    def set_max_length(self, max_length):
+        """Truncation length for the chunks tokenized from the next pass on."""
+        self.max_length = max_length
+
+    def __len__(self):
+        return self.num_rows
+
+    def num_batches(self, batch_size, num_workers=0):
+        """Batches a DataLoader yields per pass: every worker batches its own chunks and ends with its own partial batch."""
+        chunk_rows = [min(self.chunk_size, self.num_rows - start) for start in range(0, self.num_rows, self.chunk_size)]
+        shards = [sum(chunk_rows[w::num_workers]) for w in range(num_workers)] if num_workers > 1 else [self.num_rows]
+        return sum(-(-rows // batch_size) for rows in shards)
+
+    def _rows(self):
+        worker = get_worker_info()
+        row_offset = 0
+        for k, (texts, label_cells) in enumerate(iter_reviews(self.path, chunk_size=self.chunk_size)):
+            if worker is not None and k % worker.num_workers != worker.id:
+                row_offset += len(texts)
+                continue
+            ids = self.tokenizer(texts, padding=False, truncation=True, max_length=self.max_length)['input_ids']
+            labels = np.asarray(self.encode_labels(label_cells))
+            for i, row_ids in enumerate(ids):
+                yield np.asarray(row_ids, dtype=self.dtype), labels[i], row_offset + i
+            row_offset += len(texts)
+
+    def __iter__(self):
+        if not self.shuffle_buffer:
+            yield from self._rows()
+            return
+        rng = np.random.default_rng(np.random.randint(2 ** 31)) # Follows the global numpy seed, differs per epoch.
+        buffer = []
+        for item in self._rows():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            j = rng.integers(len(buffer))
+            yield buffer[j]
+            buffer[j] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Group reviews of similar length so that batch_size x longest_length stays under max_tokens.
+
+    Args:
+        lengths (array): Token length of every row.
+        max_tokens (int): Padded token budget of one batch.
+        shuffle (bool): Random buckets and batch order (training) or a fixed
+            longest-first order (evaluation).
+        max_batch_size (int): Optional cap on the number of rows per batch.
+        bucket_size (int): Number of randomly drawn rows that are sorted
+            together when shuffling; larger buckets pad less but mix less.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle, max_batch_size=None, bucket_size=4096):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        if len(self.lengths) and self.lengths.max() > max_tokens:
+            raise ValueError('max_tokens ({}) is smaller than the longest row ({})'.format(max_tokens, self.lengths.max()))
+        self._batches = None
+        self._planned = collections.deque() # (seed, number of batches) of the epochs drawn ahead by plan().
+
+    def _make_batches(self, order):
+        batches = []
+        batch = []
+        longest = 0
+        for idx in order:
+            length = self.lengths[idx]
+            new_longest = max(longest, length)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (new_longest * (len(batch) + 1) > self.max_tokens or full):
+                batches.append(batch)
+                batch = []
+                new_longest = length
+            batch.append(int(idx))
+            longest = new_longest
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _build(self, rng=np.random):
+        if not self.shuffle:
+            # Longest first, so an out-of-memory batch shows up on the first step.
+            return self._make_batches(np.argsort(-self.lengths, kind='stable'))
+        order = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(self._make_batches(bucket))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def plan(self, epochs):
+        """Draw the shuffles of the next epochs now and return their batch counts.
+
+        Only the seed of every planned epoch is kept; __iter__ rebuilds the same
+        batches from it, so the counts are exactly the batches the epochs will
+        yield (e.g. for the total steps of a learning-rate schedule).
+        """
+        counts = []
+        for _ in range(epochs):
+            seed = np.random.randint(2 ** 31)
+            counts.append(len(self._build(np.random.RandomState(seed))))
+            self._planned.append((seed, counts[-1]))
+        return counts
+
+    def __iter__(self):
+        if self._planned:
+            seed, _ = self._planned.popleft()
+            return iter(self._build(np.random.RandomState(seed)))
+        batches = self._batches if self._batches is not None else self._build()
+        self._batches = None
+        return iter(batches)
+
+    def __len__(self):
+        if self._planned:
+            return self._planned[0][1]
+        # The batch count depends on the shuffle, so build the next epoch's batches now and reuse them in __iter__.
+        if self._batches is None:
+            self._batches = self._build()
+        return len(self._batches)
+
+
+class PackedBatchSampler(TokenBudgetBatchSampler):
+    """Pack reviews into sequences of at most pack_length tokens and batch packs_per_batch sequences.
+
+    Rows are packed best-fit decreasing inside each bucket; a batch is yielded
+    as the row indices of its sequences one after the other, which PackCollator
+    turns back into the same (or fuller) sequences.
+    """
+
+    def __init__(self, lengths, pack_length, packs_per_batch, shuffle, bucket_size=4096):
+        super(PackedBatchSampler, self).__init__(lengths, pack_length, shuffle, bucket_size=bucket_size)
+        self.packs_per_batch = packs_per_batch
+
+    def _make_batches(self, order):
+        order = order[np.argsort(-self.lengths[order], kind='stable')]
+        packs = []
+        free = [] # Sorted (free tokens, pack number) of every open pack.
+        for idx in order:
+            length = int(self.lengths[idx])
+            slot = bisect.bisect_left(free, (length, -1)) # Tightest pack the row still fits in.
+            if slot < len(free):
+                space, pack = free.pop(slot)
+            else:
+                space, pack = self.max_tokens, len(packs)
+                packs.append([])
+            packs[pack].append(int(idx))
+            bisect.insort(free, (space - length, pack))
+        return [sum(packs[start:start + self.packs_per_batch], []) for start in range(0, len(packs), self.packs_per_batch)]
+
+
+class PadCollator:
+    """Pad a list of (ids, label, index) items to the longest row in the batch.
+
+    pad_to fixes the padded length instead (the original max_length behaviour).
+    """
+
+    def __init__(self, pad_token_id, pad_to=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to = pad_to
+
+    def __call__(self, items):
+        seq_len = self.pad_to or max(len(ids) for ids, _, _ in items)
+        input_ids = torch.full((len(items), seq_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), seq_len), dtype=torch.long)
+        for row, (ids, _, _) in enumerate(items):
+            input_ids[row, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+            attention_mask[row, :len(ids)] = 1
+        labels = torch.from_numpy(np.stack([label for _, label, _ in items]))
+        index = torch.tensor([idx for _, _, idx in items], dtype=torch.long)
+        return input_ids, attention_mask, labels, index
+
+
+class PackCollator:
+    """Concatenate (ids, label, index) items into sequences of at most pack_length tokens, in item order.
+
+    Returns (input_ids, segment_ids, labels, index): segment_ids numbers the
+    reviews of every sequence 1, 2, ... (0 marks padding) and takes the place
+    of the attention mask; labels and index have one row per review.
+    """
+
+    def __init__(self, pad_token_id, pack_length):
+        self.pad_token_id = pad_token_id
+        self.pack_length = pack_length
+
+    def __call__(self, items):
+        packs = [[]]
+        used = 0
+        for item in items:
+            if packs[-1] and used + len(item[0]) > self.pack_length:
+                packs.append([])
+                used = 0
+            packs[-1].append(item)
+            used += len(item[0])
+        seq_len = max(sum(len(ids) for ids, _, _ in pack) for pack in packs)
+        input_ids = torch.full((len(packs), seq_len), self.pad_token_id, dtype=torch.long)
+        segment_ids = torch.zeros((len(packs), seq_len), dtype=torch.long)
+        for row, pack in enumerate(packs):
+            start = 0
+            for segment, (ids, _, _) in enumerate(pack, 1):
+                input_ids[row, start:start + len(ids)] = torch.from_numpy(ids.astype(np.int64))
+                segment_ids[row, start:start + len(ids)] = segment
+                start += len(ids)
+        labels = torch.from_numpy(np.stack([label for _, label, _ in items]))
+        index = torch.tensor([idx for _, _, idx in items], dtype=torch.long)
+        return input_ids, segment_ids, labels, index
+
+
+class DevicePrefetcher:
+    """Iterate a DataLoader through a background thread that keeps up to depth batches ready on the device.
+
+    The thread pulls collated batches from the loader and copies them to the
+    device (on a side CUDA stream when the device is a GPU), so the next
+    batches are prepared while the current one is computed. wait_time is the
+    total time the consuming loop spent blocked on data, batches the number
+    of batches it received. depth=0 fetches and copies in the loop itself.
+    """
+
+    _done = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch, stream=None):
+        if stream is None:
+            return tuple(t.to(self.device, non_blocking=True) for t in batch), None
+        with torch.cuda.stream(stream):
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # Give up once the consumer has stopped, instead of blocking on a full queue forever.
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                if not self._put(batches, self._to_device(batch, stream), stop):
+                    return
+            self._put(batches, self._done, stop)
+        except BaseException as error: # Re-raised in the consuming thread.
+            self._put(batches, error, stop)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            iterator = iter(self.loader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = self._to_device(next(iterator))[0]
+                except StopIteration:
+                    return
+                self.wait_time += time.perf_counter() - start
+                self.batches += 1
+                yield batch
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if item is self._done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    # Compute waits for the copy, and the side-stream memory is not reused before compute is done.
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    for t in batch:
+                        t.record_stream(torch.cuda.current_stream(self.device))
+                self.batches += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+def restore_order(batches, batch_indices):
+    """Concatenate per-batch arrays and put the rows back in dataset (CSV) order."""
+    order = np.argsort(np.concatenate(batch_indices), kind='stable')
+    return np.concatenate(batches)[order]
+
+
+def tokenizer_identity(tokenizer):
+    """Name of the tokenizer directory plus a hash of its vocabulary."""
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode('utf-8')
+    name = os.path.basename(os.path.normpath(str(tokenizer.name_or_path)))
+    return '{}:{}:{}'.format(name, type(tokenizer).__name__, hashlib.sha1(vocab).hexdigest()[:12])
+
+
+def token_cache_path(cache_dir, digest, tokenizer, max_length, label_vocab=LABEL_VOCAB, dedup=False):
+    """Cache directory for one split, keyed by CSV content digest, tokenizer, max_length, label vocabulary and deduplication."""
+    key = '|'.join([digest, tokenizer_identity(tokenizer), str(max_length), '|'.join(label_vocab)] + (['dedup'] if dedup else []))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:20])
+
+
+def save_token_cache(cache_path, dataset, source=None, shard_rows=100000):
+    """Write a TokenizedDataset as .npy shards (ids_*.npy, offsets_*.npy, labels.npy; counts.npy, inverse.npy if deduplicated).
+
+    The shards are written to a temporary directory and renamed into place,
+    so an interrupted run never leaves a half-written cache behind.
+    """
+    tmp_path = cache_path + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    num_shards = 0
+    for ids, offsets in zip(dataset.ids, dataset.offsets):
+        for start in range(0, len(offsets) - 1, shard_rows):
+            stop = min(start + shard_rows, len(offsets) - 1)
+            shard_offsets = np.asarray(offsets[start:stop + 1]) - offsets[start]
+            np.save(os.path.join(tmp_path, 'ids_{:05d}.npy'.format(num_shards)), np.asarray(ids[offsets[start]:offsets[stop]]))
+            np.save(os.path.join(tmp_path, 'offsets_{:05d}.npy'.format(num_shards)), shard_offsets)
+            num_shards += 1
+    np.save(os.path.join(tmp_path, 'labels.npy'), np.asarray(dataset.labels))
+    if dataset.inverse is not None:
+        np.save(os.path.join(tmp_path, 'counts.npy'), np.asarray(dataset.counts))
+        np.save(os.path.join(tmp_path, 'inverse.npy'), np.asarray(dataset.inverse))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'rows': len(dataset), 'shards': num_shards, 'source': source}, f)
+    if os.path.exists(cache_path):
+        shutil.rmtree(tmp_path) # Another process finished the same cache first.
+    else:
+        os.rename(tmp_path, cache_path)
+
+
+def load_token_cache(cache_path):
+    """Memory-map a cached TokenizedDataset, or return None when there is no cache yet."""
+    meta_path = os.path.join(cache_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    ids = [np.load(os.path.join(cache_path, 'ids_{:05d}.npy'.format(k)), mmap_mode='r') for k in range(meta['shards'])]
+    offsets = [np.load(os.path.join(cache_path, 'offsets_{:05d}.npy'.format(k)), mmap_mode='r') for k in range(meta['shards'])]
+    labels = np.load(os.path.join(cache_path, 'labels.npy'), mmap_mode='r')
+    counts = inverse = None
+    if os.path.exists(os.path.join(cache_path, 'inverse.npy')):
+        counts = np.load(os.path.join(cache_path, 'counts.npy'))
+        inverse = np.load(os.path.join(cache_path, 'inverse.npy'), mmap_mode='r')
+    return TokenizedDataset(ids, offsets, labels, counts=counts, inverse=inverse)
+
+
+LENGTH_BINS = [0, 16, 32, 64, 128, 256, 512, 1024, 2 ** 31]
+
+
+class _DigestReader(io.RawIOBase):
+    """Raw file wrapper that hashes every byte pandas reads through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha1()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.digest.update(memoryview(b)[:n])
+        return n
+
+
+def build_manifest(path, label_vocab=LABEL_VOCAB, chunk_size=100000):
+    """Scan a split once and collect its row count, label frequencies, length histogram and content hash.
+
+    A CSV is parsed in chunks straight from a hashing reader, so the file is
+    read a single time and never held in memory as a whole. Parquet and Arrow
+    files need random access, so their bytes are hashed in a separate pass.
+    Lengths are counted in characters of the description column.
+    """
+    stat = os.stat(path)
+    rows = 0
+    label_freq = np.zeros(len(label_vocab), dtype=np.int64)
+    length_counts = np.zeros(len(LENGTH_BINS) - 1, dtype=np.int64)
+    with open(path, 'rb', buffering=0) as raw:
+        reader = _DigestReader(raw)
+        stream = io.BufferedReader(reader, buffer_size=1 << 22)
+        source = stream if table_format(path) == 'csv' else None
+        for texts, label_cells in iter_reviews(path, chunk_size=chunk_size, source=source):
+            rows += len(texts)
+            label_freq += encode_multi_hot(label_cells, label_vocab).sum(axis=0).astype(np.int64)
+            lengths = np.fromiter((len(t) if isinstance(t, str) else 0 for t in texts), dtype=np.int64, count=len(texts))
+            length_counts += np.histogram(lengths, bins=LENGTH_BINS)[0]
+        while stream.read(1 << 22): # Hash whatever the parser did not need to read.
+            pass
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': reader.digest.hexdigest(), 'rows': rows, 'label_vocab': list(label_vocab),
+            'label_freq': label_freq.tolist(), 'length_bins': LENGTH_BINS, 'length_counts': length_counts.tolist()}
+
+
+def load_manifest(path, label_vocab=LABEL_VOCAB):
+    """Read the <path>.manifest.json sidecar, rebuilding it when the file or the label vocabulary changed."""
+    sidecar = path + '.manifest.json'
+    stat = os.stat(path)
+    if os.path.exists(sidecar):
+        with open(sidecar, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns and manifest['label_vocab'] == list(label_vocab):
+            return manifest
+    manifest = build_manifest(path, label_vocab)
+    try:
+        with open(sidecar, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+    except OSError: # Read-only data directory, the manifest is simply rebuilt next time.
+        pass
+    return manifest
@@ -95,7 +95,13 @@ class ResampleLoss(nn.Module):
                 weight=None,
                 avg_factor=None,
                 reduction_override=None,
+                sample_weight=None,
+                sample_norm=None,
                 **kwargs):
+        # sample_weight: optional [batch] multiplicity of each row (deduplicated reviews).
+        # sample_norm: fixed number of rows the weighted sum is divided by instead of sample_weight.sum(),
+        # e.g. the mean rows per batch of the split, so that summed over an epoch the loss (and its gradient)
+        # equals that of the run over every copy.
 
         assert reduction_override in (None, 'none', 'mean', 'sum')
         reduction = (
@@ -115,7 +121,11 @@ class ResampleLoss(nn.Module):
                 cls_score, label.float(), weight=weight, reduction='none')
             alpha_t = torch.where(label==1, self.alpha, 1-self.alpha)
             loss = alpha_t * ((1 - pt) ** self.gamma) * wtloss ####################### balance_param should be a tensor
-            loss = reduce_loss(loss, reduction)             ############################ add reduction
+            loss = self.reduce_sample_loss(loss, reduction, sample_weight, sample_norm)             ############################ add reduction
+        elif sample_weight is not None:
+            loss = self.cls_criterion(cls_score, label.float(), weight,
+                                      reduction='none')
+            loss = self.reduce_sample_loss(loss, reduction, sample_weight, sample_norm)
         else:
             loss = self.cls_criterion(cls_score, label.float(), weight,
                                       reduction=reduction)
@@ -123,6 +133,15 @@ class ResampleLoss(nn.Module):
         loss = self.loss_weight * loss
         return loss
 
+    def reduce_sample_loss(self, loss, reduction, sample_weight=None, sample_norm=None):
+        if sample_weight is None:
+            return reduce_loss(loss, reduction)
+        sample_weight = sample_weight.float().view(-1, 1)
+        if sample_norm is None:
+            sample_norm = sample_weight.sum()
+        avg_factor = sample_norm * loss.size(1) if reduction == 'mean' else None
+        return weight_reduce_loss(loss, sample_weight, reduction, avg_factor=avg_factor)
+
     def reweight_functions(self, label):
         if self.reweight_func is None:
             return None